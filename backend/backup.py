@@ -0,0 +1,40 @@
+"""Export the knowledge base to a snapshot file, or load one, without re-embedding.
+
+A snapshot holds document records, chunk text, metadata and vectors (see
+snapshot.py) but not the original uploads. Runs against the same MongoDB and
+CHROMA_PATH as the server; a server already running rebuilds its keyword index
+from the imported chunks on restart.
+
+Usage:
+    python backup.py export knowledge-base.tar
+    python backup.py import knowledge-base.tar --tenant acme
+"""
+import argparse
+import asyncio
+import json
+from pathlib import Path
+
+import server
+
+
+async def main(args):
+    try:
+        if args.command == "export":
+            report = await server.export_snapshot(args.tenant, Path(args.path))
+        else:
+            report = await server.import_snapshot(args.tenant, Path(args.path))
+        print(json.dumps(report, indent=2))
+    finally:
+        server.cpu_executor.shutdown()
+        server.vector_executor.shutdown()
+        server.client.close()
+        server.embedder.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="snapshot file to write or read")
+    parser.add_argument("--tenant", default=server.DEFAULT_TENANT,
+                        help="tenant to export from or import into (default: DEFAULT_TENANT)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,64 @@
+"""Answer a JSONL file of questions in process, writing JSONL results.
+
+Each input line is {"question": ..., "id": optional, "filters": optional}.
+Results are written as they finish; see `server.answer_batch`. Runs against
+the same MongoDB and CHROMA_PATH as the server, without going through HTTP,
+and searches one tenant's documents (DEFAULT_TENANT unless --tenant is given).
+
+Usage:
+    python batch_chat.py questions.jsonl > answers.jsonl
+    python batch_chat.py questions.jsonl --output answers.jsonl --concurrency 8
+    python batch_chat.py - --persist < questions.jsonl   # also save as a conversation
+    python batch_chat.py questions.jsonl --tenant acme
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import server
+
+
+async def main(args):
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    with source:
+        lines = source.read().splitlines()
+    output = sys.stdout if args.output is None else open(args.output, "w", encoding="utf-8")
+
+    started = time.perf_counter()
+    answered = failed = 0
+    try:
+        if server.HYBRID_SEARCH:
+            index = await server.get_tenant_index(args.tenant)
+            await asyncio.get_running_loop().run_in_executor(server.vector_executor, server.rebuild_keyword_index, index)
+        async for result in server.answer_batch(args.tenant, lines, args.concurrency, args.persist):
+            output.write(json.dumps(result, default=str) + "\n")
+            output.flush()
+            if result.get("error"):
+                failed += 1
+            else:
+                answered += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        await server.llm.aclose()
+        server.embedder.close()
+        server.client.close()
+
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"answered": answered, "failed": failed, "seconds": round(elapsed, 2),
+                      "questions_per_second": round((answered + failed) / elapsed, 2) if elapsed else 0.0}),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file of questions, or - for stdin")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument("--concurrency", type=int, default=server.BATCH_CONCURRENCY,
+                        help="model calls in flight (default: BATCH_CONCURRENCY)")
+    parser.add_argument("--persist", action="store_true", help="save the questions and answers as a conversation")
+    parser.add_argument("--tenant", default=server.DEFAULT_TENANT,
+                        help="tenant whose documents are searched (default: DEFAULT_TENANT)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,141 @@
+"""Compare the token-aware chunker with the previous 500-word splitter.
+
+Measures chunking throughput and chunk size distribution, then indexes both
+chunk sets in an in-memory Chroma collection and checks retrieval quality as
+sentence recall@k: a sampled sentence counts as found when one of the top-k
+chunks returned for it contains the whole sentence.
+
+Usage:
+    python benchmarks/bench_chunking.py [FILES_OR_DIRS ...] [--queries 200] [--k 5]
+
+With no paths a synthetic markdown corpus is generated.
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import chromadb  # noqa: E402
+from chromadb.config import Settings  # noqa: E402
+
+from extraction import ALLOWED_TYPES, chunk_blocks, count_tokens, extract_blocks  # noqa: E402
+
+SENTENCE = re.compile(r'[^.!?\n]{40,200}[.!?]')
+
+
+def legacy_chunk_text(text, chunk_size=500, overlap=50):
+    """The original word-window chunker, kept here as the baseline"""
+    words = text.split()
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = start + chunk_size
+        chunk = ' '.join(words[start:end])
+        if chunk.strip():
+            chunks.append(chunk)
+        start = end - overlap
+    return chunks
+
+
+def synthetic_corpus(documents=20, sections=8, seed=7):
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(2000)]
+    corpus = []
+    for d in range(documents):
+        lines = []
+        for s in range(sections):
+            lines.append(f"## Section {s} of document {d}\n")
+            for _ in range(rng.randint(2, 6)):
+                sentences = [
+                    " ".join(rng.choice(vocabulary) for _ in range(rng.randint(8, 25))).capitalize() + "."
+                    for _ in range(rng.randint(2, 8))
+                ]
+                lines.append(" ".join(sentences) + "\n")
+        corpus.append((f"synthetic_{d}.md", "\n".join(lines).encode()))
+    return corpus
+
+
+def load_corpus(paths):
+    corpus = []
+    for path in map(Path, paths):
+        files = sorted(path.rglob("*")) if path.is_dir() else [path]
+        corpus.extend((f.name, f.read_bytes()) for f in files if f.suffix.lower() in ALLOWED_TYPES)
+    return corpus
+
+
+def measure(name, chunker, documents):
+    started = time.perf_counter()
+    chunked = [(filename, chunker(blocks)) for filename, blocks in documents]
+    seconds = time.perf_counter() - started
+    sizes = [count_tokens(c) for _, chunks in chunked for c in chunks]
+    return chunked, {
+        "chunker": name,
+        "chunks": len(sizes),
+        "seconds": round(seconds, 4),
+        "chunks_per_second": round(len(sizes) / seconds, 1) if seconds else None,
+        "mean_tokens": round(statistics.mean(sizes), 1) if sizes else 0,
+        "max_tokens": max(sizes, default=0),
+    }
+
+
+def recall_at_k(name, chunked, queries, k):
+    client = chromadb.Client(Settings(anonymized_telemetry=False, allow_reset=True))
+    collection = client.create_collection(f"bench_{name}", metadata={"hnsw:space": "cosine"})
+    ids, texts, metadatas = [], [], []
+    for filename, chunks in chunked:
+        for i, chunk in enumerate(chunks):
+            ids.append(f"{filename}_{i}")
+            texts.append(chunk)
+            metadatas.append({"filename": filename})
+    for start in range(0, len(ids), 1024):
+        collection.add(ids=ids[start:start + 1024], documents=texts[start:start + 1024],
+                       metadatas=metadatas[start:start + 1024])
+
+    started = time.perf_counter()
+    results = collection.query(query_texts=[q for _, q in queries], n_results=k)
+    seconds = time.perf_counter() - started
+    found = sum(
+        any(meta["filename"] == filename and sentence in doc for doc, meta in zip(docs, metas))
+        for (filename, sentence), docs, metas in zip(queries, results["documents"], results["metadatas"])
+    )
+    client.delete_collection(f"bench_{name}")
+    return {f"recall@{k}": round(found / len(queries), 3) if queries else None,
+            "query_seconds": round(seconds, 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.paths) if args.paths else synthetic_corpus(seed=args.seed)
+    documents = [(filename, list(extract_blocks(content, Path(filename).suffix.lower()))) for filename, content in corpus]
+
+    rng = random.Random(args.seed)
+    sentences = [(filename, m.group(0).strip()) for filename, blocks in documents
+                 for block in blocks for m in SENTENCE.finditer(block.text)]
+    queries = rng.sample(sentences, min(args.queries, len(sentences)))
+
+    report = {"documents": len(documents), "bytes": sum(len(c) for _, c in corpus), "queries": len(queries), "results": []}
+    for name, chunker in [
+        ("legacy_words", lambda blocks: legacy_chunk_text("".join(b.text for b in blocks))),
+        ("token_structured", lambda blocks: [c.text for c in chunk_blocks(blocks)]),
+    ]:
+        chunked, stats = measure(name, chunker, documents)
+        stats.update(recall_at_k(name, chunked, queries, args.k))
+        report["results"].append(stats)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
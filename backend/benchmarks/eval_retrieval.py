@@ -0,0 +1,157 @@
+"""Offline retrieval evaluation: vector-only search vs hybrid BM25 + vector search.
+
+Builds an in-memory Chroma collection and BM25 index over a corpus, then runs
+two query sets and reports recall@k, MRR and mean/p95 latency for each retriever:
+
+- identifier queries ask about an error code or product name that appears in
+  exactly one chunk; the hit is that chunk.
+- sentence queries use a sentence from the corpus; the hit is any chunk that
+  contains it.
+
+With --rerank, a third retriever over-fetches --candidates hybrid results and
+reranks them, so the added latency can be weighed against the change in
+recall and MRR.
+
+Usage:
+    python benchmarks/eval_retrieval.py [FILES_OR_DIRS ...] [--queries 200] [--k 5]
+        [--rerank lexical|cross-encoder] [--candidates 30]
+
+With no paths a synthetic corpus with embedded identifiers is generated, and
+only sentence queries are run on real files.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import chromadb  # noqa: E402
+from chromadb.config import Settings  # noqa: E402
+
+from extraction import chunk_blocks, extract_blocks  # noqa: E402
+from keyword_index import BM25Index, reciprocal_rank_fusion  # noqa: E402
+from rerank import get_scorer, rerank  # noqa: E402
+from bench_chunking import SENTENCE, load_corpus  # noqa: E402
+
+WORDS = ("system request server client cache index query latency memory document storage network "
+         "timeout retry config deploy cluster node replica shard token model vector search upload").split()
+
+
+def synthetic_corpus(documents, seed):
+    """Technical prose with one unique error code or product name per paragraph"""
+    rng = random.Random(seed)
+    corpus, identifiers = [], []
+    for d in range(documents):
+        paragraphs = []
+        for p in range(12):
+            identifier = rng.choice([f"ERR-{rng.randint(1000, 9999)}", f"Model-{rng.choice('XYZQ')}{rng.randint(10, 99)}"])
+            words = [rng.choice(WORDS) for _ in range(rng.randint(60, 120))]
+            words.insert(rng.randrange(len(words)), identifier)
+            text = " ".join(words)
+            paragraphs.append(text[0].upper() + text[1:] + ".")
+            identifiers.append((f"doc_{d}.txt", identifier))
+        corpus.append((f"doc_{d}.txt", "\n\n".join(paragraphs).encode()))
+    return corpus, identifiers
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--documents", type=int, default=30)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--rerank", choices=["lexical", "cross-encoder"])
+    parser.add_argument("--candidates", type=int, default=30)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    if args.paths:
+        corpus, identifiers = load_corpus(args.paths), []
+    else:
+        corpus, identifiers = synthetic_corpus(args.documents, args.seed)
+
+    client = chromadb.Client(Settings(anonymized_telemetry=False, allow_reset=True))
+    collection = client.create_collection("eval_retrieval", metadata={"hnsw:space": "cosine"})
+    index = BM25Index()
+    texts = {}
+    sentences = []
+    for filename, content in corpus:
+        blocks = list(extract_blocks(content, Path(filename).suffix.lower()))
+        chunks = chunk_blocks(blocks)
+        ids = [f"{filename}_{i}" for i in range(len(chunks))]
+        metadatas = [{"document_id": filename, "chunk_index": i} for i in range(len(chunks))]
+        documents = [chunk.text for chunk in chunks]
+        for start in range(0, len(ids), 1024):
+            collection.add(ids=ids[start:start + 1024], documents=documents[start:start + 1024],
+                           metadatas=metadatas[start:start + 1024])
+        index.add(ids, documents, metadatas)
+        texts.update(zip(ids, documents))
+        sentences.extend((filename, m.group(0).strip()) for block in blocks for m in SENTENCE.finditer(block.text))
+
+    query_sets = {"sentence": [(s, s) for _, s in rng.sample(sentences, min(args.queries, len(sentences)))]}
+    if identifiers:
+        sample = rng.sample(identifiers, min(args.queries, len(identifiers)))
+        query_sets["identifier"] = [(f"What does {identifier} refer to?", identifier) for _, identifier in sample]
+
+    pool = ThreadPoolExecutor(max_workers=2)
+
+    def vector(query):
+        return collection.query(query_texts=[query], n_results=args.k)['ids'][0]
+
+    def hybrid(query):
+        vector_future = pool.submit(collection.query, query_texts=[query], n_results=args.k * 2)
+        keyword_future = pool.submit(index.search, query, args.k * 2)
+        keyword_ids = [chunk_id for chunk_id, _ in keyword_future.result()]
+        return reciprocal_rank_fusion([vector_future.result()['ids'][0], keyword_ids])[:args.k]
+
+    scorer = get_scorer(args.rerank) if args.rerank else None
+
+    def reranked(query):
+        vector_future = pool.submit(collection.query, query_texts=[query], n_results=args.candidates)
+        keyword_future = pool.submit(index.search, query, args.candidates)
+        keyword_ids = [chunk_id for chunk_id, _ in keyword_future.result()]
+        candidates = reciprocal_rank_fusion([vector_future.result()['ids'][0], keyword_ids])[:args.candidates]
+        return [chunk_id for chunk_id, _ in rerank(scorer, query, candidates, [texts[c] for c in candidates], args.k)]
+
+    retrievers = [("vector", vector), ("hybrid", hybrid)]
+    if scorer is not None:
+        scorer.score("warm up", ["warm up"])
+        retrievers.append((f"hybrid+{args.rerank}", reranked))
+
+    report = {"documents": len(corpus), "chunks": len(texts), "k": args.k, "results": []}
+    for set_name, queries in query_sets.items():
+        for retriever_name, retriever in retrievers:
+            latencies, found, reciprocal_ranks = [], 0, 0.0
+            for query, needle in queries:
+                started = time.perf_counter()
+                ids = retriever(query)
+                latencies.append((time.perf_counter() - started) * 1000)
+                rank = next((i for i, chunk_id in enumerate(ids) if needle in texts[chunk_id]), None)
+                found += rank is not None
+                reciprocal_ranks += 1 / (rank + 1) if rank is not None else 0.0
+            report["results"].append({
+                "queries": set_name,
+                "retriever": retriever_name,
+                f"recall@{args.k}": round(found / len(queries), 3) if queries else None,
+                "mrr": round(reciprocal_ranks / len(queries), 3) if queries else None,
+                "mean_ms": round(statistics.mean(latencies), 2) if latencies else None,
+                "p95_ms": round(percentile(latencies, 95), 2) if latencies else None,
+            })
+
+    pool.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,507 @@
+"""Local load test for the ingestion and chat endpoints.
+
+Serves the FastAPI app with uvicorn on a local port, in the same process and
+event loop as the client, with no external services: MongoDB is replaced by
+mongomock-motor, ChromaDB runs in memory and the chat model is a fake that
+answers after a configurable delay. Three measurements are taken:
+
+- upload: synthetic .txt, .md, .docx and .pdf files of each size are
+  uploaded concurrently; reports files/s, MB/s, chunks/s and time until each
+  document is ready.
+- chat: /api/chat and /api/chat/stream at each concurrency level; reports
+  p50/p95/p99 latency, requests per second and, when streaming, time to
+  first token.
+- mixed: /api/chat p99 alone and while PDF and DOCX uploads run, first with
+  the server's blocking calls made inline on the event loop (as before the
+  executor pools) and then through the pools, to show what the pools buy.
+- memory: a sequential pass under tracemalloc; reports the mean and maximum
+  peak Python allocation per upload and per chat request, plus the
+  process's maximum RSS.
+
+The JSON report is printed and, with --output, saved. With --compare, the
+run is checked against a saved report and exits with status 1 when upload
+throughput, chat p99 or chat RPS is more than --tolerance worse.
+
+Usage:
+    python benchmarks/load_test.py [--sizes 10,100,1000] [--files 8]
+        [--concurrency 1,8,32] [--requests 200] [--llm-latency 0.2]
+        [--embeddings model|hash] [--output report.json]
+        [--compare baseline.json] [--tolerance 0.2]
+
+Requires mongomock-motor (pip install mongomock-motor). With --embeddings hash
+a hashed bag-of-words vectorizer replaces the embedding model, so the run
+measures the server rather than the model.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import Executor, Future
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+
+from eval_retrieval import WORDS, percentile  # noqa: E402
+
+FILE_TYPES = (".txt", ".md", ".docx", ".pdf")
+CONTENT_TYPES = {
+    ".txt": "text/plain",
+    ".md": "text/markdown",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".pdf": "application/pdf",
+}
+
+
+def load_server(upload_dir):
+    """Import the app against mongomock and an in-memory ChromaDB"""
+    try:
+        import mongomock_motor
+    except ImportError:
+        raise SystemExit("load_test.py requires the mongomock-motor package")
+    import motor.motor_asyncio
+    motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "load_test")
+    os.environ["UPLOAD_DIR"] = upload_dir
+    os.environ["EMBEDDING_CACHE_PATH"] = ""
+    os.environ.pop("CHROMA_PATH", None)
+    import server
+    return server
+
+
+class FakeChatModel:
+    """Answers every prompt with a fixed number of words after `latency` seconds"""
+
+    def __init__(self, latency, words=60):
+        self.latency = latency
+        self.words = words
+
+    def _usage(self, messages):
+        return {"input_tokens": sum(len(m.content.split()) for m in messages),
+                "output_tokens": self.words, "total_tokens": self.words}
+
+    async def ainvoke(self, messages):
+        from langchain_core.messages import AIMessage
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=" ".join(WORDS[i % len(WORDS)] for i in range(self.words)),
+                         usage_metadata=self._usage(messages))
+
+    async def astream(self, messages):
+        from langchain_core.messages import AIMessageChunk
+        for i in range(self.words):
+            await asyncio.sleep(self.latency / self.words)
+            yield AIMessageChunk(content=WORDS[i % len(WORDS)] + " ")
+
+
+def hash_embeddings(texts, dimensions=384):
+    """Deterministic bag-of-words vectors; no model, a few microseconds per text"""
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            vectors[row, int(hashlib.md5(word.encode()).hexdigest()[:8], 16) % dimensions] += 1
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def synthetic_paragraphs(size, rng, identifiers):
+    """Prose paragraphs totalling about `size` bytes, each with a unique identifier"""
+    paragraphs, total = [], 0
+    while total < size:
+        identifier = f"ERR-{rng.randint(10000, 99999)}"
+        words = [rng.choice(WORDS) for _ in range(rng.randint(60, 120))]
+        words.insert(rng.randrange(len(words)), identifier)
+        text = " ".join(words).capitalize() + "."
+        paragraphs.append(text)
+        identifiers.append(identifier)
+        total += len(text) + 2
+    return paragraphs
+
+
+def make_docx(paragraphs):
+    from docx import Document
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def make_pdf(paragraphs, line_width=90, lines_per_page=50):
+    """A minimal text-only PDF, one Helvetica line per text operator"""
+    lines = []
+    for paragraph in paragraphs:
+        words, line = paragraph.split(), ""
+        for word in words:
+            if len(line) + len(word) + 1 > line_width:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}" if line else word
+        lines.extend([line, ""])
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in pages:
+        text = "".join(
+            "(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") Tj T* "
+            for line in page
+        )
+        stream = f"BT /F1 10 Tf 12 TL 50 800 Td {text}ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    output, offsets = io.BytesIO(), []
+    output.write(b"%PDF-1.4\n")
+    for number, body in enumerate(objects, 1):
+        offsets.append(output.tell())
+        output.write(f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+    xref = output.tell()
+    output.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    output.write("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode())
+    output.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return output.getvalue()
+
+
+def make_file(file_type, size, rng, identifiers):
+    paragraphs = synthetic_paragraphs(size, rng, identifiers)
+    if file_type == ".docx":
+        return make_docx(paragraphs)
+    if file_type == ".pdf":
+        return make_pdf(paragraphs)
+    if file_type == ".md":
+        return "\n\n".join(f"## Section {i}\n\n{p}" for i, p in enumerate(paragraphs)).encode()
+    return "\n\n".join(paragraphs).encode()
+
+
+async def upload_one(client, server, filename, content, file_type):
+    """Upload a file and wait for its ingestion job; returns (seconds until ready, document)"""
+    started = time.perf_counter()
+    response = await client.post("/api/documents/upload",
+                                 files={"file": (filename, content, CONTENT_TYPES[file_type])})
+    response.raise_for_status()
+    doc = response.json()
+    job = server.ingest_jobs.get(doc["id"])
+    if job is not None:
+        await job
+    status = (await client.get(f"/api/documents/{doc['id']}/status")).json()
+    return time.perf_counter() - started, status
+
+
+async def bench_uploads(client, server, args, rng, identifiers):
+    results = []
+    semaphore = asyncio.Semaphore(args.upload_concurrency)
+
+    async def bounded(*upload):
+        async with semaphore:
+            return await upload_one(client, server, *upload)
+
+    for file_type in args.file_types:
+        for size_kb in args.sizes:
+            files = [(f"load_{file_type[1:]}_{size_kb}kb_{i}{file_type}",
+                      make_file(file_type, size_kb * 1024, rng, identifiers), file_type)
+                     for i in range(args.files)]
+            started = time.perf_counter()
+            outcomes = await asyncio.gather(*(bounded(*f) for f in files))
+            seconds = time.perf_counter() - started
+            ready = [seconds_ready * 1000 for seconds_ready, status in outcomes if status["status"] == "ready"]
+            chunks = sum(status["chunk_count"] for _, status in outcomes)
+            total_bytes = sum(len(content) for _, content, _ in files)
+            results.append({
+                "file_type": file_type,
+                "size_kb": size_kb,
+                "files": len(files),
+                "failed": len(files) - len(ready),
+                "chunks": chunks,
+                "seconds": round(seconds, 3),
+                "files_per_second": round(len(files) / seconds, 2),
+                "mb_per_second": round(total_bytes / seconds / 1e6, 3),
+                "chunks_per_second": round(chunks / seconds, 1),
+                "ready_p50_ms": round(percentile(ready, 50), 1) if ready else None,
+                "ready_p99_ms": round(percentile(ready, 99), 1) if ready else None,
+            })
+            print(f"upload {file_type} {size_kb}KB: {results[-1]['files_per_second']} files/s", file=sys.stderr)
+    return results
+
+
+async def chat_once(client, endpoint, conversation_id, question):
+    """Send one chat request; returns (latency, time to first token or None)"""
+    payload = {"conversation_id": conversation_id, "message": question}
+    started = time.perf_counter()
+    if endpoint == "chat":
+        response = await client.post("/api/chat", json=payload)
+        response.raise_for_status()
+        return time.perf_counter() - started, None
+    first_token = None
+    async with client.stream("POST", "/api/chat/stream", json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if first_token is None and line == "event: token":
+                first_token = time.perf_counter() - started
+    return time.perf_counter() - started, first_token
+
+
+async def run_chat(client, endpoint, concurrency, questions):
+    """Send `questions` from `concurrency` conversations at once; returns a report row"""
+    conversations = [(await client.post("/api/conversations")).json()["id"] for _ in range(concurrency)]
+    latencies, first_tokens, errors = [], [], 0
+
+    async def worker(conversation_id, share):
+        nonlocal errors
+        for question in share:
+            try:
+                latency, first_token = await chat_once(client, endpoint, conversation_id, question)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(latency * 1000)
+            if first_token is not None:
+                first_tokens.append(first_token * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(conversation_id, questions[i::concurrency])
+                           for i, conversation_id in enumerate(conversations)))
+    seconds = time.perf_counter() - started
+    row = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(questions),
+        "errors": errors,
+        "rps": round(len(latencies) / seconds, 2),
+        "mean_ms": round(statistics.mean(latencies), 1) if latencies else None,
+        "p50_ms": round(percentile(latencies, 50), 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95), 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 1) if latencies else None,
+    }
+    if first_tokens:
+        row["ttft_p50_ms"] = round(percentile(first_tokens, 50), 1)
+        row["ttft_p99_ms"] = round(percentile(first_tokens, 99), 1)
+    return row
+
+
+async def bench_chat(client, args, rng, identifiers):
+    results = []
+    for endpoint in args.endpoints:
+        for concurrency in args.concurrency:
+            questions = [f"What does {rng.choice(identifiers)} refer to?" for _ in range(args.requests)]
+            results.append(await run_chat(client, endpoint, concurrency, questions))
+            row = results[-1]
+            print(f"{endpoint} x{concurrency}: {row['rps']} req/s, p99 {row['p99_ms']} ms", file=sys.stderr)
+    return results
+
+
+class InlineExecutor(Executor):
+    """Runs each call at once on the calling thread, as when blocking calls were made on the event loop"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+async def bench_mixed(client, server, args, rng, identifiers):
+    """Chat latency alone and during a stream of uploads, with blocking calls inline and in the pools"""
+    results = []
+    pools = (server.cpu_executor, server.vector_executor, server.query_executor)
+    try:
+        for executors in ("inline", "pooled"):
+            if executors == "inline":
+                server.cpu_executor = server.vector_executor = server.query_executor = InlineExecutor()
+            else:
+                server.cpu_executor, server.vector_executor, server.query_executor = pools
+            for uploads in ("none", "concurrent"):
+                questions = [f"What does {rng.choice(identifiers)} refer to?" for _ in range(args.mixed_requests)]
+                chat = asyncio.create_task(run_chat(client, "chat", args.mixed_concurrency, questions))
+                uploaded = 0
+
+                async def upload_while_chatting(worker):
+                    nonlocal uploaded
+                    i = 0
+                    while not chat.done():
+                        file_type = (".pdf", ".docx")[i % 2]
+                        content = make_file(file_type, args.mixed_upload_kb * 1024, rng, identifiers)
+                        await upload_one(client, server, f"mixed_{executors}_{worker}_{i}{file_type}", content, file_type)
+                        uploaded += 1
+                        i += 1
+
+                uploaders = [asyncio.create_task(upload_while_chatting(w)) for w in range(args.upload_concurrency)] \
+                    if uploads == "concurrent" else []
+                row = await chat
+                await asyncio.gather(*uploaders)
+                row = {"executors": executors, "uploads": uploads, "uploads_completed": uploaded, **row}
+                results.append(row)
+                print(f"chat with {executors} executors, uploads {uploads}: p99 {row['p99_ms']} ms", file=sys.stderr)
+    finally:
+        server.cpu_executor, server.vector_executor, server.query_executor = pools
+    return results
+
+
+async def bench_memory(client, server, args, rng, identifiers):
+    """Peak traced allocation per request, measured one request at a time"""
+    uploads, chats = [], []
+    conversation_id = (await client.post("/api/conversations")).json()["id"]
+    tracemalloc.start()
+    try:
+        for i in range(args.memory_requests):
+            file_type = FILE_TYPES[i % len(FILE_TYPES)]
+            content = make_file(file_type, args.sizes[0] * 1024, rng, identifiers)
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            await upload_one(client, server, f"memory_{i}{file_type}", content, file_type)
+            uploads.append((tracemalloc.get_traced_memory()[1] - baseline) / 1024)
+
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            await chat_once(client, "chat", conversation_id, f"What does {rng.choice(identifiers)} refer to?")
+            chats.append((tracemalloc.get_traced_memory()[1] - baseline) / 1024)
+    finally:
+        tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "requests": args.memory_requests,
+        "upload_size_kb": args.sizes[0],
+        "upload_peak_kb_mean": round(statistics.mean(uploads), 1),
+        "upload_peak_kb_max": round(max(uploads), 1),
+        "chat_peak_kb_mean": round(statistics.mean(chats), 1),
+        "chat_peak_kb_max": round(max(chats), 1),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "max_rss_mb": round(max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Regressions of more than `tolerance` against a baseline report"""
+    regressions = []
+    previous = {(row["file_type"], row["size_kb"]): row for row in baseline.get("upload", [])}
+    for row in report.get("upload", []):
+        old = previous.get((row["file_type"], row["size_kb"]))
+        if old and row["files_per_second"] < old["files_per_second"] * (1 - tolerance):
+            regressions.append(f"upload {row['file_type']} {row['size_kb']}KB: "
+                               f"{old['files_per_second']} -> {row['files_per_second']} files/s")
+    previous = {(row["endpoint"], row["concurrency"]): row for row in baseline.get("chat", [])}
+    previous.update({("mixed " + row["uploads"], row["concurrency"]): row
+                     for row in baseline.get("mixed", []) if row["executors"] == "pooled"})
+    mixed = [{**row, "endpoint": "mixed " + row["uploads"]} for row in report.get("mixed", [])
+             if row["executors"] == "pooled"]
+    for row in report.get("chat", []) + mixed:
+        old = previous.get((row["endpoint"], row["concurrency"]))
+        if not old:
+            continue
+        name = f"{row['endpoint']} x{row['concurrency']}"
+        if old["p99_ms"] and row["p99_ms"] and row["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {old['p99_ms']} -> {row['p99_ms']} ms")
+        if row["rps"] < old["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {old['rps']} -> {row['rps']} req/s")
+    return regressions
+
+
+async def serve(app):
+    """Start uvicorn on a free local port; returns the server and its base URL"""
+    import uvicorn
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    uvicorn_server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="off"))
+    task = asyncio.create_task(uvicorn_server.serve(sockets=[sock]))
+    while not uvicorn_server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    return uvicorn_server, task, f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix="load_test_") as upload_dir:
+        server = load_server(upload_dir)
+        server.llm.model = FakeChatModel(args.llm_latency)
+        if args.embeddings == "hash":
+            server.embedder._model = hash_embeddings
+        await server.prepare_database()
+
+        report = {
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            },
+        }
+        identifiers = []
+        uvicorn_server, task, base_url = await serve(server.app)
+        limits = httpx.Limits(max_connections=max(args.concurrency + [args.upload_concurrency]))
+        try:
+            async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+                report["upload"] = await bench_uploads(client, server, args, rng, identifiers)
+                report["chat"] = await bench_chat(client, args, rng, identifiers)
+                if args.mixed_requests:
+                    report["mixed"] = await bench_mixed(client, server, args, rng, identifiers)
+                if args.memory_requests:
+                    report["memory"] = await bench_memory(client, server, args, rng, identifiers)
+        finally:
+            uvicorn_server.should_exit = True
+            await task
+            await server.shutdown_db_client()
+    return report
+
+
+def parse_list(convert):
+    return lambda value: [convert(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file-types", type=parse_list(str), default=list(FILE_TYPES))
+    parser.add_argument("--sizes", type=parse_list(int), default=[10, 100, 1000], help="file sizes in KB")
+    parser.add_argument("--files", type=int, default=8, help="files per type and size")
+    parser.add_argument("--upload-concurrency", type=int, default=4)
+    parser.add_argument("--endpoints", type=parse_list(str), default=["chat", "stream"])
+    parser.add_argument("--concurrency", type=parse_list(int), default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="chat requests per endpoint and concurrency")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds the fake model takes to answer")
+    parser.add_argument("--mixed-requests", type=int, default=200,
+                        help="chat requests per mixed-load run; 0 skips the mixed-load pass")
+    parser.add_argument("--mixed-concurrency", type=int, default=8)
+    parser.add_argument("--mixed-upload-kb", type=int, default=500, help="size of each file uploaded during chat")
+    parser.add_argument("--memory-requests", type=int, default=20, help="0 skips the memory pass")
+    parser.add_argument("--embeddings", choices=["model", "hash"], default="model")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output")
+    parser.add_argument("--compare", help="baseline report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.compare:
+        regressions = compare(report, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
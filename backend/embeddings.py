@@ -0,0 +1,134 @@
+"""Embedding layer for chunks and queries.
+
+The model runs locally on CPU: either the ONNX all-MiniLM-L6-v2 bundled with
+ChromaDB or any sentence-transformers model. Texts are encoded in batches and
+chunk vectors are cached on disk by the hash of their text, so re-indexing
+only embeds text that has not been seen before.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+import metrics
+
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'onnx')  # onnx or sentence-transformers
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+EMBEDDING_DEVICE = os.environ.get('EMBEDDING_DEVICE', 'cpu')
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', '64'))
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def load_model(backend: str, model_name: str, device: str) -> Callable[[List[str]], np.ndarray]:
+    """Load a local embedding model as a function from texts to a float32 matrix"""
+    if backend == 'onnx':
+        from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+        embedding_function = DefaultEmbeddingFunction()
+        return lambda texts: np.asarray(embedding_function(texts), dtype=np.float32)
+    if backend == 'sentence-transformers':
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError("EMBEDDING_BACKEND=sentence-transformers requires the sentence-transformers package")
+        model = SentenceTransformer(model_name, device=device)
+        return lambda texts: model.encode(
+            texts, batch_size=len(texts), normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+class EmbeddingCache:
+    """Vectors on disk in SQLite, keyed by model and text hash"""
+
+    def __init__(self, path: str, model_key: str):
+        self.model_key = model_key
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, hash))"
+        )
+        self._lock = threading.Lock()
+
+    def get_many(self, hashes: Iterable[str]) -> Dict[str, np.ndarray]:
+        hashes = list(hashes)
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [self.model_key, *batch]
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, vectors: Dict[str, np.ndarray]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                [(self.model_key, key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in vectors.items()]
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class Embedder:
+    """Batched embeddings from a local model, with an optional on-disk cache
+
+    The model is loaded on first use. Safe to call from several threads.
+    """
+
+    def __init__(self, backend: str = EMBEDDING_BACKEND, model_name: str = EMBEDDING_MODEL,
+                 device: str = EMBEDDING_DEVICE, batch_size: int = EMBEDDING_BATCH_SIZE,
+                 cache_path: Optional[str] = None):
+        self.backend = backend
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.cache = EmbeddingCache(cache_path, f"{backend}:{model_name}") if cache_path else None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> Callable[[List[str]], np.ndarray]:
+        with self._lock:
+            if self._model is None:
+                logging.info(f"Loading {self.backend} embedding model {self.model_name}")
+                self._model = load_model(self.backend, self.model_name, self.device)
+            return self._model
+
+    def encode(self, texts: List[str]) -> List[np.ndarray]:
+        """Run the model over `texts` in batches, bypassing the cache"""
+        vectors: List[np.ndarray] = []
+        for start in range(0, len(texts), self.batch_size):
+            started = time.perf_counter()
+            vectors.extend(self.model(texts[start:start + self.batch_size]))
+            metrics.EMBEDDING_SECONDS.observe(time.perf_counter() - started)
+        metrics.EMBEDDED_TEXTS.inc(len(texts), result="computed")
+        return vectors
+
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        """Embed chunk texts, reusing cached vectors for text embedded before"""
+        if self.cache is None:
+            return self.encode(texts)
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.cache.get_many(set(hashes))
+        metrics.EMBEDDED_TEXTS.inc(sum(1 for key in hashes if key in vectors), result="cached")
+        missing = {key: text for key, text in zip(hashes, texts) if key not in vectors}
+        if missing:
+            computed = dict(zip(missing, self.encode(list(missing.values()))))
+            self.cache.put_many(computed)
+            vectors.update(computed)
+        return [vectors[key] for key in hashes]
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,229 @@
+"""Text extraction and chunking for uploaded documents.
+
+Kept free of database and vector store state so the functions can run in
+worker processes.
+"""
+import io
+import os
+import re
+import tempfile
+import zipfile
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import tiktoken
+from pypdf import PdfReader
+from docx import Document as DocxDocument
+
+ALLOWED_TYPES = {'.pdf', '.txt', '.md', '.docx'}
+
+# Chunk sizes are measured in tokens of the chat model's encoding
+CHUNK_TOKENS = int(os.environ.get('CHUNK_TOKENS', '512'))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', '64'))
+TOKEN_ENCODING = os.environ.get('TOKEN_ENCODING', 'o200k_base')
+
+MARKDOWN_HEADING = re.compile(r'^#{1,6}\s+(.*)$', re.MULTILINE)
+# Opening or closing line of a fenced code block, whose lines are never headings
+MARKDOWN_FENCE = re.compile(r'^ {0,3}(```|~~~)')
+# A run of text up to a blank line or the end of the block; lines may end in spaces, tabs or \r
+PARAGRAPH = re.compile(r'\S(?:.*?\S)?(?=[ \t\r]*\n\s*\n|\s*$)', re.DOTALL)
+
+class Block(NamedTuple):
+    """A structural unit of a document: a PDF page, a DOCX paragraph or a paragraph of a markdown section"""
+    text: str
+    page: Optional[int] = None
+    heading: Optional[str] = None
+    offset: int = 0  # character offset of the block within its page or section
+
+class Chunk(NamedTuple):
+    text: str
+    tokens: int
+    page: Optional[int] = None
+    heading: Optional[str] = None
+    offset: int = 0  # character offset of the chunk within its page or section
+    page_end: Optional[int] = None  # last page the chunk covers, when that is not `page`
+
+# An upload given either as its bytes or as the path of the stored file
+Source = Union[bytes, str, os.PathLike]
+
+def open_source(source: Source) -> BinaryIO:
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return open(source, 'rb')
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    return tiktoken.get_encoding(TOKEN_ENCODING)
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+def extract_blocks_from_pdf(source: Source) -> Iterator[Block]:
+    """Extract one block per PDF page, reading pages as they are needed"""
+    with open_source(source) as stream:
+        reader = PdfReader(stream)
+        for i, page in enumerate(reader.pages):
+            yield Block(page.extract_text() or "", page=i + 1)
+
+def extract_blocks_from_docx(source: Source) -> Iterator[Block]:
+    """Extract DOCX paragraphs, tagging each with the heading it falls under"""
+    with open_source(source) as stream:
+        doc = DocxDocument(stream)
+    heading = None
+    for para in doc.paragraphs:
+        if para.style is not None and para.style.name.startswith('Heading'):
+            heading = para.text.strip() or heading
+        yield Block(para.text, heading=heading)
+
+def extract_blocks_from_txt(source: Source) -> Iterator[Block]:
+    """Read TXT/MD line by line, one block per paragraph, tracking markdown headings
+    
+    Blocks keep their trailing blank lines, so together they reproduce the file.
+    `#` lines inside fenced code blocks are code, not headings.
+    """
+    with io.TextIOWrapper(open_source(source), encoding='utf-8', errors='ignore', newline='') as text:
+        heading = None
+        lines: List[str] = []
+        offset = 0  # of the buffered paragraph within its section
+        position = 0  # of the next line within its section
+        blank = False
+        fence = None  # marker of the open code fence
+        for line in text:
+            marker = MARKDOWN_FENCE.match(line)
+            match = None if fence or marker else MARKDOWN_HEADING.match(line.rstrip('\r\n'))
+            if marker and fence is None:
+                fence = marker.group(1)
+            elif marker and marker.group(1) == fence:
+                fence = None
+            if match or (blank and line.strip()):
+                if lines:
+                    yield Block("".join(lines), heading=heading, offset=offset)
+                if match:
+                    heading = match.group(1).strip()
+                    position = 0
+                lines, offset = [], position
+            blank = not line.strip()
+            lines.append(line)
+            position += len(line)
+        if lines:
+            yield Block("".join(lines), heading=heading, offset=offset)
+
+def extract_blocks(source: Source, file_ext: str) -> Iterator[Block]:
+    """Extract structural blocks based on file type, lazily"""
+    if file_ext == '.pdf':
+        return extract_blocks_from_pdf(source)
+    elif file_ext == '.docx':
+        return extract_blocks_from_docx(source)
+    return extract_blocks_from_txt(source)
+
+def iter_chunks(blocks: Iterable[Block], chunk_tokens: int = CHUNK_TOKENS,
+                overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Chunk]:
+    """Pack paragraphs into chunks of at most `chunk_tokens` tokens in one pass
+
+    Chunks never cross a heading; a new page only starts a new chunk when the
+    current one is full, and a chunk spanning pages records its last page as
+    `page_end`. Paragraphs
+    longer than the budget are split into token windows overlapping by
+    `overlap_tokens`. When a chunk fills up, its last paragraph is carried into
+    the next one if it fits in the overlap. Chunks are yielded as soon as they
+    are complete, so only the current chunk is held in memory.
+    """
+    encoding = get_encoding()
+    parts: List[tuple] = []  # (paragraph, tokens, page, offset) of the chunk being built
+    size = 0  # tokens in parts, counting one token per paragraph separator
+    heading = None
+
+    def close() -> Optional[Chunk]:
+        nonlocal parts, size
+        chunk = None
+        if parts:
+            first, last = parts[0][2], parts[-1][2]
+            chunk = Chunk("\n\n".join(p[0] for p in parts), size, first, heading, parts[0][3],
+                          last if last != first else None)
+        parts, size = [], 0
+        return chunk
+
+    for block in blocks:
+        if block.heading != heading:
+            chunk = close()
+            if chunk:
+                yield chunk
+            heading = block.heading
+        for match in PARAGRAPH.finditer(block.text):
+            paragraph = match.group(0)
+            tokens = encoding.encode(paragraph, disallowed_special=())
+
+            if len(tokens) > chunk_tokens:
+                # Oversized paragraph: close the current chunk and window through it
+                chunk = close()
+                if chunk:
+                    yield chunk
+                step = max(chunk_tokens - overlap_tokens, 1)
+                position = block.offset + match.start()
+                for start in range(0, len(tokens), step):
+                    window = tokens[start:start + chunk_tokens]
+                    yield Chunk(encoding.decode(window), len(window), block.page, heading, position)
+                    if start + chunk_tokens >= len(tokens):
+                        break
+                    position += len(encoding.decode(tokens[start:start + step]))
+                continue
+
+            if parts and size + 1 + len(tokens) > chunk_tokens:
+                carried = parts[-1] if parts[-1][1] <= overlap_tokens else None
+                yield close()
+                if carried and carried[1] + 1 + len(tokens) <= chunk_tokens:
+                    parts, size = [carried], carried[1]
+            size += len(tokens) + (1 if parts else 0)
+            parts.append((paragraph, len(tokens), block.page, block.offset + match.start()))
+    chunk = close()
+    if chunk:
+        yield chunk
+
+def chunk_blocks(blocks: Iterable[Block], chunk_tokens: int = CHUNK_TOKENS,
+                 overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Chunk]:
+    """Pack paragraphs into token-sized chunks; see `iter_chunks`"""
+    return list(iter_chunks(blocks, chunk_tokens, overlap_tokens))
+
+def extract_chunks(source: Source, file_ext: str) -> List[Chunk]:
+    """Extract and chunk an upload"""
+    return chunk_blocks(extract_blocks(source, file_ext))
+
+def extract_file_chunks(path: str, file_ext: str) -> List[Chunk]:
+    """Extract and chunk a stored upload"""
+    return extract_chunks(path, file_ext)
+
+def iter_file_chunks(path: str, file_ext: str) -> Iterator[Chunk]:
+    """Stream the chunks of a stored upload as its pages or paragraphs are read"""
+    return iter_chunks(extract_blocks(path, file_ext))
+
+def extract_archive(source: Source, dest_dir: str, max_member_size: Optional[int] = None) -> List[Tuple[str, str]]:
+    """Unpack the files in a zip archive to temporary files, one member at a time
+    
+    Returns (filename, path) pairs; the caller owns the temporary files. A
+    member that unpacks to more than `max_member_size` bytes raises ValueError.
+    """
+    files = []
+    try:
+        with zipfile.ZipFile(open_source(source)) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.startswith('__MACOSX/'):
+                    continue
+                name = Path(info.filename).name
+                if max_member_size is not None and info.file_size > max_member_size:
+                    raise ValueError(f"{name} is larger than {max_member_size} bytes")
+                with tempfile.NamedTemporaryFile(dir=dest_dir, suffix='.part', delete=False) as out:
+                    files.append((name, out.name))
+                    with archive.open(info) as member:
+                        # The size in the archive's directory is not trusted, so count while copying
+                        size = 0
+                        while piece := member.read(1024 * 1024):
+                            size += len(piece)
+                            if max_member_size is not None and size > max_member_size:
+                                raise ValueError(f"{name} is larger than {max_member_size} bytes")
+                            out.write(piece)
+    except Exception:
+        for _, path in files:
+            Path(path).unlink(missing_ok=True)
+        raise
+    return files
@@ -0,0 +1,137 @@
+"""In-process BM25 keyword index kept alongside the ChromaDB collection.
+
+Vector search is weak on exact identifiers such as error codes, version
+numbers and product names; the keyword index catches those, and the two
+rankings are combined with reciprocal rank fusion.
+"""
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Words, plus identifiers joined by - _ . such as ERR-1234 or v2.1.0
+TOKEN = re.compile(r'[a-z0-9]+(?:[-_.][a-z0-9]+)*')
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase terms; compound identifiers are indexed whole and by their parts"""
+    terms = []
+    for match in TOKEN.finditer(text.lower()):
+        term = match.group(0)
+        terms.append(term)
+        if not term.isalnum():
+            terms.extend(re.split(r'[-_.]', term))
+    return terms
+
+class BM25Index:
+    """Inverted index over chunk text scored with Okapi BM25
+
+    Safe to update and search from several threads.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)  # term -> chunk_id -> term frequency
+        self.lengths: Dict[str, int] = {}  # chunk_id -> number of terms
+        self.chunk_terms: Dict[str, List[str]] = {}  # chunk_id -> distinct terms, for removal
+        self.document_chunks: Dict[str, set] = defaultdict(set)  # document_id -> chunk_ids
+        self.total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, ids: Iterable[str], texts: Iterable[str], metadatas: Iterable[dict]):
+        """Index chunks, replacing any already indexed under the same ID"""
+        tokenized = [(chunk_id, Counter(tokenize(text)), metadata.get('document_id'))
+                     for chunk_id, text, metadata in zip(ids, texts, metadatas)]
+        with self._lock:
+            for chunk_id, counts, doc_id in tokenized:
+                self._remove_chunk(chunk_id)
+                for term, tf in counts.items():
+                    self.postings[term][chunk_id] = tf
+                length = sum(counts.values())
+                self.lengths[chunk_id] = length
+                self.chunk_terms[chunk_id] = list(counts)
+                self.document_chunks[doc_id].add(chunk_id)
+                self.total_length += length
+
+    def _remove_chunk(self, chunk_id: str):
+        for term in self.chunk_terms.pop(chunk_id, ()):
+            postings = self.postings[term]
+            postings.pop(chunk_id, None)
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(chunk_id, 0)
+
+    def remove_chunks(self, doc_id: str, chunk_ids: Iterable[str]):
+        with self._lock:
+            chunks = self.document_chunks.get(doc_id, set())
+            for chunk_id in chunk_ids:
+                chunks.discard(chunk_id)
+                self._remove_chunk(chunk_id)
+
+    def remove_document(self, doc_id: str):
+        with self._lock:
+            for chunk_id in self.document_chunks.pop(doc_id, ()):
+                self._remove_chunk(chunk_id)
+
+    def compact(self):
+        """Drop emptied entries and copy the tables, returning memory freed by removals"""
+        with self._lock:
+            self.postings = defaultdict(dict, {term: dict(p) for term, p in self.postings.items() if p})
+            self.lengths = dict(self.lengths)
+            self.chunk_terms = dict(self.chunk_terms)
+            self.document_chunks = defaultdict(set, {d: set(c) for d, c in self.document_chunks.items() if c})
+    
+    def clear(self):
+        with self._lock:
+            self.postings.clear()
+            self.lengths.clear()
+            self.chunk_terms.clear()
+            self.document_chunks.clear()
+            self.total_length = 0
+
+    def search(self, query: str, n_results: int = 10,
+               document_ids: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        """Return up to `n_results` (chunk_id, score) pairs, best first
+        
+        With `document_ids`, only chunks of those documents are scored. IDF and
+        average length still come from the whole index.
+        """
+        terms = set(tokenize(query))
+        scores: Dict[str, float] = defaultdict(float)
+        with self._lock:
+            count = len(self.lengths)
+            if not count:
+                return []
+            allowed = None
+            if document_ids is not None:
+                allowed = set()
+                for doc_id in document_ids:
+                    allowed.update(self.document_chunks.get(doc_id, ()))
+                if not allowed:
+                    return []
+            average_length = self.total_length / count
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                if allowed is not None and len(allowed) < len(postings):
+                    postings = {chunk_id: postings[chunk_id] for chunk_id in allowed if chunk_id in postings}
+                elif allowed is not None:
+                    postings = {chunk_id: tf for chunk_id, tf in postings.items() if chunk_id in allowed}
+                for chunk_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / average_length)
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n_results]
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int = 60) -> List[str]:
+    """Merge ranked ID lists, scoring each ID by the sum of 1 / (k + rank)"""
+    scores: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
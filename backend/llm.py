@@ -0,0 +1,136 @@
+"""Process-wide chat model client with bounded concurrency and retries.
+
+One model instance, and with it one pooled HTTP client, is shared by every
+request. A semaphore caps the calls in flight so bursts queue here instead
+of tripping the provider's rate limits; rate-limited and overloaded calls
+are retried with exponential backoff.
+"""
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+
+import openai
+
+import metrics
+
+# Timeouts are not retried: the caller has already waited the full timeout once
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait, from the Retry-After header"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, RETRYABLE_ERRORS) and not isinstance(error, openai.APITimeoutError)
+
+class ChatClient:
+    """Shares one chat model across requests and limits calls in flight
+
+    The model is created on first use by `model_factory`; assign `model` to
+    swap in a fake model locally.
+    """
+
+    def __init__(self, model_factory: Callable, max_concurrency: int = 8, max_retries: int = 4,
+                 backoff_base: float = 0.5, backoff_max: float = 20.0):
+        self.model_factory = model_factory
+        self._model = None
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self.model_factory()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    async def aclose(self):
+        """Close the pooled HTTP client, if the model has one"""
+        http_client = getattr(self._model, "http_async_client", None)
+        if http_client is not None:
+            await http_client.aclose()
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Exponential backoff with full jitter, or the provider's Retry-After if longer"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after(error) or 0.0)
+
+    @asynccontextmanager
+    async def slot(self, operation: str):
+        """Wait for a free call slot, recording the queueing delay"""
+        queued = time.perf_counter()
+        self.waiting += 1
+        metrics.LLM_WAITING.set(self.waiting)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            metrics.LLM_WAITING.set(self.waiting)
+        metrics.LLM_QUEUE_SECONDS.observe(time.perf_counter() - queued, operation=operation)
+        self.in_flight += 1
+        metrics.LLM_IN_FLIGHT.set(self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            metrics.LLM_IN_FLIGHT.set(self.in_flight)
+            self.semaphore.release()
+
+    async def _retry_wait(self, attempt: int, error: Exception, operation: str) -> bool:
+        """Sleep before the next attempt, or return False when the error is final"""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            metrics.LLM_REQUESTS.inc(operation=operation, result=type(error).__name__)
+            return False
+        delay = self.backoff(attempt, error)
+        metrics.LLM_RETRIES.inc(operation=operation, error=type(error).__name__)
+        logging.warning(f"LLM {operation} failed with {type(error).__name__}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+        return True
+
+    async def ainvoke(self, messages):
+        """Call the model once a slot is free, retrying rate limits and overloads"""
+        async with self.slot("invoke"):
+            attempt = 0
+            while True:
+                try:
+                    response = await self.model.ainvoke(messages)
+                    metrics.LLM_REQUESTS.inc(operation="invoke", result="ok")
+                    return response
+                except Exception as e:
+                    if not await self._retry_wait(attempt, e, "invoke"):
+                        raise
+                    attempt += 1
+
+    async def astream(self, messages) -> AsyncIterator:
+        """Stream the model's response; only failures before the first chunk are retried"""
+        async with self.slot("stream"):
+            attempt = 0
+            while True:
+                started = False
+                try:
+                    async for chunk in self.model.astream(messages):
+                        started = True
+                        yield chunk
+                    metrics.LLM_REQUESTS.inc(operation="stream", result="ok")
+                    return
+                except Exception as e:
+                    if started or not await self._retry_wait(attempt, e, "stream"):
+                        if started:
+                            metrics.LLM_REQUESTS.inc(operation="stream", result=type(e).__name__)
+                        raise
+                    attempt += 1
@@ -0,0 +1,147 @@
+"""Minimal Prometheus-style metrics and request-scoped tracing spans.
+
+Metrics are kept in process and rendered in the Prometheus text exposition
+format by the /metrics endpoint. `span()` times one stage of a request,
+records it in the stage histogram and logs it as a structured JSON line
+tagged with the current request ID.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Sequence, Tuple
+
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+trace_logger = logging.getLogger("rag.trace")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def _label_text(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(line + "\n" for line in self.samples())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_label_text(self.label_names, key)} {value}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            state[bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, state in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), state[:-1]):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_label_text(self.label_names, key, le)} {cumulative}")
+                lines.append(f"{self.name}_count{_label_text(self.label_names, key)} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(self.label_names, key)} {state[-1]}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self.metrics)
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"])
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "Latency of each RAG pipeline stage", ["stage"])
+PROMPT_TOKENS = Counter("rag_prompt_tokens_total", "Prompt tokens sent to the chat model", ["part"])
+COMPLETION_TOKENS = Counter("rag_completion_tokens_total", "Completion tokens reported by the chat model")
+UPLOAD_CHUNKS = Histogram("rag_upload_chunks", "Chunks produced per uploaded document", ["file_type"], buckets=SIZE_BUCKETS)
+INGEST_CHUNKS = Counter("rag_ingest_chunks_total", "Chunks handled on re-upload of a changed document", ["action"])
+EXTRACTION_SECONDS = Histogram("rag_extraction_duration_seconds", "Text extraction and chunking time per document", ["file_type"])
+EMBEDDED_TEXTS = Counter("rag_embedded_texts_total", "Texts embedded, by whether the vector came from the cache", ["result"])
+EMBEDDING_SECONDS = Histogram("rag_embedding_batch_seconds", "Time to embed one batch of texts")
+GC_REMOVED = Counter("rag_gc_removed_total", "Documents purged and orphaned documents cleaned up by the garbage collector", ["kind"])
+RERANK_TIMEOUTS = Counter("rag_rerank_timeouts_total", "Rerankings abandoned for exceeding RERANK_TIMEOUT")
+LLM_REQUESTS = Counter("rag_llm_requests_total", "Chat model calls by final result", ["operation", "result"])
+LLM_RETRIES = Counter("rag_llm_retries_total", "Chat model calls retried after a retryable error", ["operation", "error"])
+LLM_QUEUE_SECONDS = Histogram("rag_llm_queue_seconds", "Time spent waiting for a free chat model call slot", ["operation"])
+LLM_WAITING = Gauge("rag_llm_waiting", "Chat model calls waiting for a slot")
+LLM_IN_FLIGHT = Gauge("rag_llm_in_flight", "Chat model calls in flight")
+WRITE_BEHIND_PENDING = Gauge("rag_write_behind_pending", "Chat turns queued for the background writer")
+CACHE_REQUESTS = Gauge("rag_cache_requests", "Cache lookups by result", ["cache", "result"])
+CACHE_ENTRIES = Gauge("rag_cache_entries", "Entries held by each cache", ["cache"])
+
+@contextmanager
+def span(stage: str, **fields):
+    """Time a pipeline stage, record it and log it with the current request ID"""
+    started = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace_logger.info(json.dumps({
+            "request_id": request_id_var.get(),
+            "span": stage,
+            "ms": round(elapsed * 1000, 2),
+            **fields
+        }, default=str))
@@ -0,0 +1,35 @@
+"""Reconcile MongoDB with the vector store and rebuild missing vectors.
+
+Usage:
+    python reindex.py          # reindex documents whose vectors are missing
+    python reindex.py --all    # rebuild vectors for every document
+"""
+import argparse
+import asyncio
+import json
+
+import server
+
+
+async def main(rebuild_all: bool):
+    try:
+        report = await server.reconcile_vector_store()
+        doc_ids = None
+        if rebuild_all:
+            docs = await server.db.documents.find({}, {"_id": 0, "id": 1}).to_list(None)
+            doc_ids = [doc['id'] for doc in docs]
+        report.update(await server.reindex_documents(doc_ids))
+        print(json.dumps(report, indent=2))
+    finally:
+        server.cpu_executor.shutdown()
+        server.vector_executor.shutdown()
+        server.extract_pool.shutdown()
+        server.client.close()
+        server.embedder.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--all", action="store_true", help="rebuild vectors for every document")
+    args = parser.parse_args()
+    asyncio.run(main(args.all))
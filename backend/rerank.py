@@ -0,0 +1,111 @@
+"""Optional reranking of retrieved chunks before they are packed into the prompt.
+
+Retrieval over-fetches candidates, a local CPU scorer reads each one together
+with the question, and only the best are kept. Two scorers are available:
+
+- cross-encoder: a sentence-transformers cross-encoder such as
+  ms-marco-MiniLM-L-6-v2; the most accurate, a few milliseconds per candidate.
+- lexical: weighted query-term coverage and proximity; no model, around a
+  millisecond per candidate, and good at exact identifiers.
+"""
+import logging
+import math
+import os
+import threading
+from collections import Counter
+from typing import List, Optional, Sequence
+
+from keyword_index import tokenize
+
+RERANK_BACKEND = os.environ.get('RERANK_BACKEND', 'none')  # none, lexical or cross-encoder
+RERANK_MODEL = os.environ.get('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+RERANK_BATCH_SIZE = int(os.environ.get('RERANK_BATCH_SIZE', '32'))
+RERANK_MAX_LENGTH = int(os.environ.get('RERANK_MAX_LENGTH', '256'))  # tokens of question + passage
+
+class LexicalScorer:
+    """Scores passages by the IDF-weighted share of query terms they contain
+
+    IDF is computed over the candidate set. Passages whose matched terms sit
+    close together get a small bonus.
+    """
+
+    def score(self, query: str, passages: Sequence[str]) -> List[float]:
+        terms = set(tokenize(query))
+        if not terms or not passages:
+            return [0.0] * len(passages)
+        tokenized = [tokenize(passage) for passage in passages]
+        frequency = Counter(term for tokens in tokenized for term in set(tokens) & terms)
+        idf = {term: math.log(1 + (len(passages) + 1) / (frequency[term] + 1)) for term in terms}
+        total = sum(idf.values())
+        return [self._score(tokens, terms, idf, total) for tokens in tokenized]
+
+    @staticmethod
+    def _score(tokens: List[str], terms: set, idf: dict, total: float) -> float:
+        positions = {}
+        for i, token in enumerate(tokens):
+            if token in terms:
+                positions.setdefault(token, []).append(i)
+        if not positions:
+            return 0.0
+        coverage = sum(idf[term] for term in positions) / total
+        # Shortest window containing every matched term, by a sweep over all matches
+        matches = sorted((i, term) for term, found in positions.items() for i in found)
+        window, counts, start = len(tokens), Counter(), 0
+        for position, term in matches:
+            counts[term] += 1
+            while len(counts) == len(positions):
+                window = min(window, position - matches[start][0] + 1)
+                counts[matches[start][1]] -= 1
+                if not counts[matches[start][1]]:
+                    del counts[matches[start][1]]
+                start += 1
+        return coverage + 0.1 * len(positions) / window
+
+class CrossEncoderScorer:
+    """Scores (question, passage) pairs with a sentence-transformers cross-encoder"""
+
+    def __init__(self, model_name: str = RERANK_MODEL, batch_size: int = RERANK_BATCH_SIZE,
+                 max_length: int = RERANK_MAX_LENGTH):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                except ImportError:
+                    raise RuntimeError("RERANK_BACKEND=cross-encoder requires the sentence-transformers package")
+                logging.info(f"Loading reranking model {self.model_name}")
+                self._model = CrossEncoder(self.model_name, device='cpu', max_length=self.max_length)
+            return self._model
+
+    def score(self, query: str, passages: Sequence[str]) -> List[float]:
+        if not passages:
+            return []
+        scores = self.model.predict([(query, passage) for passage in passages], batch_size=self.batch_size)
+        return [float(score) for score in scores]
+
+def get_scorer(backend: str = RERANK_BACKEND):
+    """The scorer for a backend name, or None when reranking is off"""
+    if backend in ('', 'none'):
+        return None
+    if backend == 'lexical':
+        return LexicalScorer()
+    if backend == 'cross-encoder':
+        return CrossEncoderScorer()
+    raise ValueError(f"Unknown rerank backend: {backend}")
+
+def rerank(scorer, query: str, ids: List[str], passages: List[str],
+           top_k: Optional[int] = None) -> List[tuple]:
+    """Order candidates by score, best first, as (id, score) pairs
+
+    Ties keep the incoming order, so retrieval rank breaks them.
+    """
+    scores = scorer.score(query, passages)
+    ranked = sorted(range(len(ids)), key=lambda i: -scores[i])
+    return [(ids[i], scores[i]) for i in ranked[:top_k]]
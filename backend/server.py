@@ -1,21 +1,46 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Request, Response, Query, Header, Depends
 from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import Callable, Iterator, List, Optional, Dict
+from collections import Counter, OrderedDict
 import uuid
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timezone
 import aiofiles
 import chromadb
 from chromadb.config import Settings
-from pypdf import PdfReader
-from docx import Document as DocxDocument
-import io
-import tiktoken
+import numpy as np
+import re
+import json
+import time
+import functools
+import hashlib
+import itertools
+import tempfile
+import contextvars
+import contextlib
+import threading
+import base64
+import httpx
+import openai
+from extraction import ALLOWED_TYPES, Chunk, count_tokens, extract_archive, extract_file_chunks, iter_file_chunks
+from keyword_index import BM25Index, reciprocal_rank_fusion
+import metrics
+from metrics import span
+from llm import ChatClient
+from embeddings import Embedder, text_hash
+from rerank import RERANK_BACKEND, get_scorer, rerank
+from snapshot import SnapshotReader, SnapshotWriter
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 
@@ -24,18 +49,54 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
-# ChromaDB client for vector storage
-chroma_client = chromadb.Client(Settings(
+# ChromaDB client for vector storage; set CHROMA_PATH to keep vectors on disk across restarts
+CHROMA_PATH = os.environ.get('CHROMA_PATH')
+chroma_settings = Settings(
     anonymized_telemetry=False,
     allow_reset=True
-))
-collection = chroma_client.get_or_create_collection(
-    name="documents",
-    metadata={"hnsw:space": "cosine"}
 )
+if CHROMA_PATH:
+    chroma_client = chromadb.PersistentClient(path=CHROMA_PATH, settings=chroma_settings)
+else:
+    chroma_client = chromadb.Client(chroma_settings)
+
+# Every document, conversation and chat request belongs to the tenant named in the
+# X-Tenant-ID header, or DEFAULT_TENANT without one. Each tenant's chunks live in
+# their own ChromaDB collection and BM25 index, created on first use, so a query
+# only searches that tenant's corpus. DEFAULT_TENANT keeps the `documents` collection.
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
+TENANT_PATTERN = re.compile(r"[A-Za-z0-9](?:[A-Za-z0-9_-]{0,62}[A-Za-z0-9])?")
+
+# Local embedding model; chunk vectors are cached on disk by text hash (set EMBEDDING_CACHE_PATH empty to disable)
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', str(ROOT_DIR / 'embedding_cache.sqlite3'))
+embedder = Embedder(cache_path=EMBEDDING_CACHE_PATH or None)
+
+# BM25 keyword indexes are kept in step with the collections and rebuilt from ChromaDB on startup
+HYBRID_SEARCH = os.environ.get('HYBRID_SEARCH', 'true').lower() == 'true'
+RRF_K = int(os.environ.get('RRF_K', '60'))
+
+# Repeated questions reuse their query embedding and, while the indexed chunks are
+# unchanged, their search results; 0 disables either cache
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get('QUERY_EMBEDDING_CACHE_SIZE', '1000'))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get('RETRIEVAL_CACHE_SIZE', '1000'))
+# A tenant's corpus version is bumped after every change to its indexed chunks and
+# is part of every retrieval cache key
+corpus_versions = itertools.count(1)
+
+# Default and maximum page sizes for list endpoints
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+
+# Original uploads are kept so vectors can be rebuilt without re-uploading
+UPLOAD_DIR = Path(os.environ.get('UPLOAD_DIR', ROOT_DIR / 'uploads'))
+UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# Uploads are streamed to disk in pieces of this many bytes rather than read whole
+UPLOAD_READ_SIZE = int(os.environ.get('UPLOAD_READ_SIZE', str(1024 * 1024)))
+# Largest file a zip archive in a batch upload may unpack to
+MAX_ARCHIVE_MEMBER_SIZE = int(os.environ.get('MAX_ARCHIVE_MEMBER_SIZE', str(200 * 1024 * 1024)))
 
 # Create the main app
 app = FastAPI()
@@ -43,262 +104,1483 @@ api_router = APIRouter(prefix="/api")
 
 # OPENAI_API_KEY
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+# Set OPENAI_BASE_URL to point at a local OpenAI-compatible server
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL')
+
+# Chat model calls: one shared client, at most LLM_MAX_CONCURRENCY in flight, rate limits retried with backoff
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '8'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '4'))
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', '60'))
+
+# Retrieval: over-fetch candidates, then pack the best ones into the prompt's context budget
+RETRIEVAL_CANDIDATES = int(os.environ.get('RETRIEVAL_CANDIDATES', '10'))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '3000'))
+
+# Optional reranking (RERANK_BACKEND): over-fetch RERANK_CANDIDATES, keep the best RERANK_TOP_K.
+# If scoring takes longer than RERANK_TIMEOUT seconds the retrieval order is used instead.
+RERANK_CANDIDATES = int(os.environ.get('RERANK_CANDIDATES', '30'))
+RERANK_TOP_K = int(os.environ.get('RERANK_TOP_K', '5'))
+RERANK_TIMEOUT = float(os.environ.get('RERANK_TIMEOUT', '0.5'))
+reranker = get_scorer(RERANK_BACKEND)
+
+# Conversation memory: recent turns within HISTORY_TOKEN_BUDGET are sent verbatim,
+# older turns are folded into a rolling summary stored on the conversation
+HISTORY_MAX_MESSAGES = int(os.environ.get('HISTORY_MAX_MESSAGES', '10'))
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', '1500'))
+background_tasks: set = set()
+
+# Batch question answering: questions are retrieved BATCH_CHUNK_SIZE at a time,
+# with at most BATCH_CONCURRENCY of a batch's model calls in flight
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', '64'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+
+# With WRITE_BEHIND, chat turns are persisted by a background writer after the
+# response is sent, batching up to WRITE_BEHIND_BATCH turns per MongoDB write
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', 'false').lower() == 'true'
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', '256'))
+
+# Blocking work never runs on the event loop. It goes to one of three thread pools:
+# - cpu_executor (CPU_WORKERS): parsing, chunking, hashing and chunk embedding
+# - vector_executor (VECTOR_STORE_WORKERS): every ChromaDB call and keyword search
+# - query_executor (QUERY_WORKERS): query embedding and reranking, so chat never
+#   queues behind parsing and ChromaDB queries never queue behind model scoring
+# INGEST_WORKERS caps how many uploads are processed at once.
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '4'))
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', '64'))
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', str(INGEST_WORKERS)))
+VECTOR_STORE_WORKERS = int(os.environ.get('VECTOR_STORE_WORKERS', '8'))
+QUERY_WORKERS = int(os.environ.get('QUERY_WORKERS', '4'))
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+vector_executor = ThreadPoolExecutor(max_workers=VECTOR_STORE_WORKERS, thread_name_prefix="vector-store")
+query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+
+# Bulk ingestion (batch upload, reindex) extracts in worker processes, since PDF
+# parsing is CPU-bound, and writes chunks across documents in large batches.
+EXTRACT_PROCESSES = int(os.environ.get('EXTRACT_PROCESSES', str(os.cpu_count() or 2)))
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', '1024'))
+extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+ingest_semaphore = asyncio.Semaphore(INGEST_WORKERS)
+
+# Deletion tombstones a document first and then removes its chunks by ID,
+# DELETE_BATCH_SIZE IDs per call. Every GC_INTERVAL seconds (0 disables) the
+# garbage collector retries failed deletions and drops orphaned chunks.
+DELETE_BATCH_SIZE = int(os.environ.get('DELETE_BATCH_SIZE', '5000'))
+GC_INTERVAL = float(os.environ.get('GC_INTERVAL', '3600'))
+# Full scans of a collection (consistency checks, keyword index rebuilds, exports)
+# read SCAN_PAGE_SIZE chunks per call
+SCAN_PAGE_SIZE = int(os.environ.get('SCAN_PAGE_SIZE', '5000'))
+ingest_jobs: Dict[str, asyncio.Task] = {}
 
 # Models
 class DocumentModel(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     filename: str
     file_type: str
     file_size: int
     chunk_count: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    status: str = "processing"
+    status: str = "processing"  # processing, ready, stale (vectors missing), failed or deleting
+    progress: float = 0.0
+    error: Optional[str] = None
+    content_hash: Optional[str] = None  # sha256 of the uploaded file
+    version: int = 1  # bumped each time a changed file is uploaded under the same name
+    versions: List[dict] = []  # previous versions, oldest first
+
+class DocumentStatus(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    status: str
+    progress: float = 0.0
+    chunk_count: int = 0
+    error: Optional[str] = None
+
+class BatchUploadItem(BaseModel):
+    filename: str
+    document_id: Optional[str] = None
+    status: str
+    chunk_count: int = 0
+    error: Optional[str] = None
+
+class BatchUploadResponse(BaseModel):
+    results: List[BatchUploadItem]
+    files: int
+    ready: int
+    failed: int
+    duplicates: int
+    chunks: int
+    bytes: int
+    seconds: float
+    files_per_second: float
+    chunks_per_second: float
+
+class DocumentDeleteRequest(BaseModel):
+    ids: List[str]
+
+class DocumentDeleteResponse(BaseModel):
+    deleted: List[str]
+    not_found: List[str]
+    pending: List[str]  # tombstoned, but chunk removal failed; retried by the garbage collector
 
 class DocumentCreate(BaseModel):
     filename: str
     file_type: str
     file_size: int
 
+class RetrievalFilter(BaseModel):
+    """Restricts retrieval to a subset of documents; unset fields do not filter"""
+    document_ids: Optional[List[str]] = None
+    file_types: Optional[List[str]] = None  # extensions such as ".pdf"
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
 class Conversation(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     title: str = "New Conversation"
+    summary: str = ""  # rolling summary of turns that no longer fit in the history budget
+    filters: Optional[RetrievalFilter] = None  # default retrieval filter for every turn
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Message(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     conversation_id: str
     role: str  # user or assistant
     content: str
     sources: List[dict] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class ConversationCreate(BaseModel):
+    title: str = "New Conversation"
+    filters: Optional[RetrievalFilter] = None
+
 class ChatRequest(BaseModel):
     conversation_id: str
     message: str
+    filters: Optional[RetrievalFilter] = None  # overrides the conversation's filters for this turn
+
+class PromptUsage(BaseModel):
+    prompt_tokens: int = 0
+    context_tokens: int = 0
+    history_tokens: int = 0
+    chunks_retrieved: int = 0
+    chunks_used: int = 0
+
+class ChatHistory(BaseModel):
+    summary: str = ""
+    summary_until: Optional[datetime] = None  # created_at of the last summarized message
+    messages: List[dict] = []  # recent messages sent verbatim, oldest first
+    overflow: List[dict] = []  # older unsummarized messages to fold into the summary
+    tokens: int = 0
+    filters: Optional[RetrievalFilter] = None
+
+class RetrievedContext(BaseModel):
+    sources: List[dict] = []
+    context: str = ""
+    chunk_ids: List[str] = []
+    usage: PromptUsage = Field(default_factory=PromptUsage)
 
 class ChatResponse(BaseModel):
     message: Message
     sources: List[dict]
+    usage: Optional[PromptUsage] = None
+
+class BatchQuestion(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: Optional[str] = None  # echoed back so results can be matched to questions
+    question: str
+    filters: Optional[RetrievalFilter] = None
+
+# Tenants
+class TenantIndex:
+    """A tenant's ChromaDB collection, the BM25 index kept in step with it and its corpus version"""
+
+    def __init__(self, tenant: str, collection):
+        self.tenant = tenant
+        self.collection = collection
+        self.keyword_index = BM25Index()
+        self.version = next(corpus_versions)
+
+    def bump_version(self):
+        """Invalidate cached retrieval results; call after the chunks change, not before"""
+        self.version = next(corpus_versions)
+
+tenant_indexes: Dict[str, TenantIndex] = {}
+tenant_indexes_lock = threading.Lock()
+
+def get_tenant(x_tenant_id: Optional[str] = Header(None)) -> str:
+    """The tenant a request acts for, from the X-Tenant-ID header"""
+    if x_tenant_id is None:
+        return DEFAULT_TENANT
+    if not TENANT_PATTERN.fullmatch(x_tenant_id):
+        raise HTTPException(status_code=400, detail="Invalid X-Tenant-ID: use up to 64 letters, digits, '-' or '_'")
+    return x_tenant_id
+
+def collection_name(tenant: str) -> str:
+    return "documents" if tenant == DEFAULT_TENANT else f"documents_{tenant}"
+
+def tenant_index(tenant: str) -> TenantIndex:
+    """The cached index of a tenant, creating its ChromaDB collection on first use"""
+    index = tenant_indexes.get(tenant)
+    if index is None:
+        with tenant_indexes_lock:
+            index = tenant_indexes.get(tenant)
+            if index is None:
+                # Vectors are always computed by `embedder` and passed in, so the collection has no embedding function
+                collection = chroma_client.get_or_create_collection(
+                    name=collection_name(tenant),
+                    metadata={"hnsw:space": "cosine"},
+                    embedding_function=None
+                )
+                index = tenant_indexes[tenant] = TenantIndex(tenant, collection)
+    return index
+
+async def get_tenant_index(tenant: str) -> TenantIndex:
+    """`tenant_index` for the event loop: a tenant's first use creates its collection on the vector pool"""
+    index = tenant_indexes.get(tenant)
+    if index is None:
+        index = await asyncio.get_running_loop().run_in_executor(vector_executor, tenant_index, tenant)
+    return index
+
+def stored_tenants() -> List[str]:
+    """Tenants that have a collection in ChromaDB"""
+    tenants = []
+    for stored in chroma_client.list_collections():
+        if stored.name == "documents":
+            tenants.append(DEFAULT_TENANT)
+        elif stored.name.startswith("documents_"):
+            tenants.append(stored.name[len("documents_"):])
+    return tenants
+
+async def all_tenants() -> List[str]:
+    """Every tenant with documents in MongoDB or chunks in ChromaDB"""
+    stored = await asyncio.get_running_loop().run_in_executor(vector_executor, stored_tenants)
+    return sorted(set(stored) | {tenant for tenant in await db.documents.distinct("tenant_id") if tenant})
 
 # Helper functions
-def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-    """Split text into chunks with overlap"""
-    words = text.split()
-    chunks = []
-    start = 0
-    while start < len(words):
-        end = start + chunk_size
-        chunk = ' '.join(words[start:end])
-        if chunk.strip():
-            chunks.append(chunk)
-        start = end - overlap
-    return chunks
-
-def extract_text_from_pdf(content: bytes) -> str:
-    """Extract text from PDF file"""
-    reader = PdfReader(io.BytesIO(content))
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text() or ""
-    return text
+def stored_file_path(doc_id: str, file_ext: str) -> Path:
+    """Location of the original upload for a document"""
+    return UPLOAD_DIR / f"{doc_id}{file_ext}"
 
-def extract_text_from_docx(content: bytes) -> str:
-    """Extract text from DOCX file"""
-    doc = DocxDocument(io.BytesIO(content))
-    text = ""
-    for para in doc.paragraphs:
-        text += para.text + "\n"
-    return text
+def hash_file(path: Path) -> str:
+    """sha256 of a file, read in pieces"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while piece := f.read(UPLOAD_READ_SIZE):
+            digest.update(piece)
+    return digest.hexdigest()
+
+async def save_upload(file: UploadFile) -> tuple:
+    """Stream an upload to a temporary file in UPLOAD_DIR, hashing it on the way
+    
+    Returns the temporary path, the sha256 of the content and its size.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, name = tempfile.mkstemp(dir=UPLOAD_DIR, suffix='.part')
+    os.close(fd)
+    try:
+        async with aiofiles.open(name, 'wb') as f:
+            while piece := await file.read(UPLOAD_READ_SIZE):
+                digest.update(piece)
+                size += len(piece)
+                await f.write(piece)
+    except BaseException:
+        Path(name).unlink(missing_ok=True)
+        raise
+    return Path(name), digest.hexdigest(), size
+
+async def write_chunks(index: TenantIndex, ids: List[str], documents: List[str], metadatas: List[dict],
+                       embeddings: Optional[List] = None):
+    """Embed chunks on the CPU pool, then upsert them into a tenant's collection and keyword index
+    
+    Pass `embeddings` to store vectors that are already known instead of embedding the text.
+    """
+    loop = asyncio.get_running_loop()
+    if embeddings is None:
+        embeddings = await loop.run_in_executor(cpu_executor, embedder.embed, documents)
+    await loop.run_in_executor(vector_executor, upsert_chunks, index, ids, documents, metadatas, embeddings)
+
+def upsert_chunks(index: TenantIndex, ids: List[str], documents: List[str], metadatas: List[dict], embeddings: List):
+    index.collection.upsert(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+    if HYBRID_SEARCH:
+        index.keyword_index.add(ids, documents, metadatas)
+    index.bump_version()
+
+def delete_document_chunks(index: TenantIndex, doc_ids: List[str]):
+    """Delete every chunk of the given documents from a tenant's collection and keyword index"""
+    index.collection.delete(where={"document_id": {"$in": doc_ids}})
+    for doc_id in doc_ids:
+        index.keyword_index.remove_document(doc_id)
+    index.bump_version()
+
+def delete_removed_chunks(index: TenantIndex, doc_id: str, chunk_ids: List[str]):
+    """Delete chunks a new version of a document no longer has from its tenant's collection and keyword index"""
+    index.collection.delete(ids=chunk_ids)
+    index.keyword_index.remove_chunks(doc_id, chunk_ids)
+    index.bump_version()
+
+def delete_chunks_from(index: TenantIndex, doc_id: str, start: int):
+    """Delete a document's chunks from index `start` on, left behind by a longer earlier extraction"""
+    where = {"$and": [{"document_id": doc_id}, {"chunk_index": {"$gte": start}}]}
+    chunk_ids = index.collection.get(where=where, include=[])['ids']
+    if chunk_ids:
+        delete_removed_chunks(index, doc_id, chunk_ids)
+
+def chunk_metadata(doc: dict, index: int, chunk: Chunk) -> dict:
+    """ChromaDB metadata for a chunk of a document record; page and heading are only set when known
+    
+    File type and upload time (epoch seconds) are copied from the document so
+    retrieval filters can be evaluated inside ChromaDB.
+    """
+    metadata = {"document_id": doc['id'], "filename": doc['filename'], "chunk_index": index,
+                "offset": chunk.offset, "tokens": chunk.tokens,
+                "hash": text_hash(chunk.text), "file_type": doc['file_type'],
+                "uploaded_at": int(doc['created_at'].timestamp())}
+    if chunk.page is not None:
+        metadata["page"] = chunk.page
+    if chunk.page_end is not None:
+        metadata["page_end"] = chunk.page_end
+    if chunk.heading:
+        metadata["heading"] = chunk.heading
+    return metadata
+
+def page_label(source: dict) -> str:
+    """"page 3" or "pages 3-4" for a source or chunk metadata, or "" when the page is unknown"""
+    if not source.get('page'):
+        return ""
+    if source.get('page_end'):
+        return f"pages {source['page']}-{source['page_end']}"
+    return f"page {source['page']}"
+
+async def update_document_status(doc_id: str, **fields):
+    """Update processing fields on a document record, unless it is being deleted"""
+    await db.documents.update_one({"id": doc_id, "status": {"$ne": "deleting"}}, {"$set": fields})
+
+def stored_chunks(index: TenantIndex, doc_id: str) -> Dict[str, dict]:
+    """Metadata of the chunks stored for a document, by chunk ID"""
+    page = index.collection.get(where={"document_id": doc_id}, include=["metadatas"])
+    return dict(zip(page['ids'], page['metadatas']))
+
+def diff_chunks(stored: Dict[str, dict], ids: List[str], metadatas: List[dict]):
+    """Diff a document's new chunks against the ones stored for its previous version
+    
+    Returns the positions that need embedding, the positions whose text is
+    already embedded (mapped to the stored chunk to copy the vector from) and
+    the stored chunk IDs no longer in use. Chunks whose text and metadata are
+    both unchanged are left alone.
+    """
+    by_hash = {}
+    for chunk_id, metadata in stored.items():
+        if 'hash' in metadata:
+            by_hash.setdefault(metadata['hash'], chunk_id)
+    embed: List[int] = []
+    reuse: Dict[int, str] = {}
+    for i, (chunk_id, metadata) in enumerate(zip(ids, metadatas)):
+        if stored.get(chunk_id) == metadata:
+            continue
+        source = by_hash.get(metadata['hash'])
+        if source is None:
+            embed.append(i)
+        else:
+            reuse[i] = source
+    current = set(ids)
+    removed = [chunk_id for chunk_id in stored if chunk_id not in current]
+    return embed, reuse, removed
+
+def stored_embeddings(index: TenantIndex, chunk_ids: List[str]) -> Dict[str, list]:
+    if not chunk_ids:
+        return {}
+    page = index.collection.get(ids=chunk_ids, include=["embeddings"])
+    return dict(zip(page['ids'], page['embeddings']))
+
+def spool_chunks(doc: dict, spool, keep_metadata: bool) -> tuple:
+    """Stream a stored upload's chunks into `spool` as JSON lines
+    
+    Only the chunk being built is held in memory. Returns the chunk count and,
+    with `keep_metadata`, every chunk's metadata.
+    """
+    count = 0
+    metadatas = []
+    path = stored_file_path(doc['id'], doc['file_type'])
+    for i, chunk in enumerate(iter_file_chunks(str(path), doc['file_type'])):
+        metadata = chunk_metadata(doc, i, chunk)
+        spool.write(json.dumps({"text": chunk.text, "metadata": metadata}) + "\n")
+        if keep_metadata:
+            metadatas.append(metadata)
+        count = i + 1
+    spool.seek(0)
+    return count, metadatas
+
+def read_spool(spool, n: int) -> List[dict]:
+    return [json.loads(line) for line in itertools.islice(spool, n)]
+
+async def process_document(doc: dict, replace: bool = False):
+    """Extract, chunk and embed a stored upload in the ingestion pool
+    
+    Chunks are streamed from the file to a temporary spool and then embedded
+    one batch at a time, so memory stays flat however large the file is.
+    
+    With `replace`, the document already has chunks from a previous version:
+    only chunks whose text changed are embedded, moved chunks keep their
+    vectors and chunks that no longer exist are deleted.
+    """
+    doc_id, file_ext = doc['id'], doc['file_type']
+    index = await get_tenant_index(doc['tenant_id'])
+    loop = asyncio.get_running_loop()
+    async with ingest_semaphore:
+        try:
+            with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as spool:
+                started = time.perf_counter()
+                count, metadatas = await loop.run_in_executor(cpu_executor, spool_chunks, doc, spool, replace)
+                metrics.EXTRACTION_SECONDS.observe(time.perf_counter() - started, file_type=file_ext)
+                metrics.UPLOAD_CHUNKS.observe(count, file_type=file_ext)
+                await update_document_status(doc_id, chunk_count=count, progress=0.1)
+                
+                ids = [f"{doc_id}_{i}" for i in range(count)]
+                if replace:
+                    stored = await loop.run_in_executor(vector_executor, stored_chunks, index, doc_id)
+                    embed, reuse, removed = diff_chunks(stored, ids, metadatas)
+                    # Read reused vectors up front: their chunks may be overwritten below
+                    vectors = await loop.run_in_executor(vector_executor, stored_embeddings, index, list(set(reuse.values())))
+                    metrics.INGEST_CHUNKS.inc(len(embed), action="embedded")
+                    metrics.INGEST_CHUNKS.inc(len(reuse), action="reused")
+                    metrics.INGEST_CHUNKS.inc(count - len(embed) - len(reuse), action="unchanged")
+                    metrics.INGEST_CHUNKS.inc(len(removed), action="removed")
+                    pending = set(embed) | set(reuse)
+                else:
+                    reuse, removed, vectors = {}, [], {}
+                    pending = None  # every chunk
+                del metadatas
+                
+                # Add to ChromaDB with metadata, one batch at a time so progress can be reported
+                total = count if pending is None else len(pending)
+                written = 0
+                for start in range(0, count, INGEST_BATCH_SIZE):
+                    if doc_id not in ingest_jobs:
+                        break
+                    lines = await loop.run_in_executor(cpu_executor, read_spool, spool, INGEST_BATCH_SIZE)
+                    positions = [i for i in range(start, start + len(lines)) if pending is None or i in pending]
+                    embedded = [i for i in positions if i not in reuse]
+                    for group, copy_vectors in ((embedded, False), ([i for i in positions if i in reuse], True)):
+                        if not group:
+                            continue
+                        await write_chunks(
+                            index,
+                            ids=[ids[i] for i in group],
+                            documents=[lines[i - start]["text"] for i in group],
+                            metadatas=[lines[i - start]["metadata"] for i in group],
+                            embeddings=[vectors[reuse[i]] for i in group] if copy_vectors else None
+                        )
+                    written += len(positions)
+                    if positions:
+                        await update_document_status(doc_id, progress=round(0.1 + 0.9 * written / total, 3))
+            
+            if removed and doc_id in ingest_jobs:
+                await loop.run_in_executor(vector_executor, delete_removed_chunks, index, doc_id, removed)
+            
+            if doc_id not in ingest_jobs:
+                # Deleted while processing: drop whatever was already added
+                await loop.run_in_executor(vector_executor, delete_document_chunks, index, [doc_id])
+                return
+            
+            await update_document_status(doc_id, status="ready", progress=1.0)
+        except Exception as e:
+            logging.error(f"Error processing document {doc_id}: {e}")
+            await update_document_status(doc_id, status="failed", error=str(e))
+        finally:
+            if replace:
+                # Chunk IDs are reused across versions, so answers cached during the re-ingest may quote old text
+                answer_cache.invalidate_document(doc_id)
+            release_ingest_job(doc_id, asyncio.current_task())
+
+# Vector store consistency
+def scan_collection(index: TenantIndex, include: List[str]) -> Iterator[dict]:
+    """Every chunk of a tenant's collection, as `collection.get` pages of SCAN_PAGE_SIZE"""
+    offset = 0
+    while True:
+        page = index.collection.get(include=include, limit=SCAN_PAGE_SIZE, offset=offset)
+        yield page
+        if len(page['ids']) < SCAN_PAGE_SIZE:
+            return
+        offset += SCAN_PAGE_SIZE
+
+def get_chunk_counts(index: TenantIndex) -> Dict[str, int]:
+    """Count chunks per document in a tenant's collection, paging through metadata only"""
+    counts: Dict[str, int] = {}
+    for page in scan_collection(index, ["metadatas"]):
+        for metadata in page['metadatas']:
+            doc_id = metadata.get('document_id')
+            counts[doc_id] = counts.get(doc_id, 0) + 1
+    return counts
 
-def extract_text_from_txt(content: bytes) -> str:
-    """Extract text from TXT/MD file"""
-    return content.decode('utf-8', errors='ignore')
+def rebuild_keyword_index(index: TenantIndex):
+    """Rebuild a tenant's BM25 index from the chunks stored in its collection"""
+    index.keyword_index.clear()
+    for page in scan_collection(index, ["documents", "metadatas"]):
+        index.keyword_index.add(page['ids'], page['documents'], page['metadatas'])
+    index.bump_version()
 
-async def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Get embeddings using chromadb's default embedding function"""
-    # ChromaDB has built-in embedding - we use document IDs for retrieval
-    return [[0.0] * 384] * len(texts)  # Placeholder, chromadb handles internally
+async def remove_orphans(index: TenantIndex, counts: Dict[str, int], known: set) -> List[str]:
+    """Delete a tenant's chunks whose document has no MongoDB record and is not being ingested"""
+    orphans = [doc_id for doc_id in counts if doc_id not in known and doc_id not in ingest_jobs]
+    if orphans:
+        await asyncio.get_running_loop().run_in_executor(vector_executor, delete_document_chunks, index, orphans)
+    return orphans
+
+async def reconcile_vector_store(tenant: Optional[str] = None) -> dict:
+    """Mark documents whose vectors are missing as stale and drop orphaned chunks
+    
+    Documents left in `processing` by a previous run are also marked stale so
+    that the next reindex finishes them. Covers one tenant, or every tenant
+    when `tenant` is None.
+    """
+    loop = asyncio.get_running_loop()
+    report = {"documents": 0, "stale": 0, "orphans_removed": 0}
+    for tenant in [tenant] if tenant else await all_tenants():
+        index = await get_tenant_index(tenant)
+        counts = await loop.run_in_executor(vector_executor, get_chunk_counts, index)
+        docs = await db.documents.find(
+            {"tenant_id": tenant}, {"_id": 0, "id": 1, "status": 1, "chunk_count": 1}
+        ).to_list(None)
+        
+        stale = []
+        for doc in docs:
+            if doc['status'] == 'processing' and doc['id'] not in ingest_jobs:
+                stale.append(doc['id'])
+            elif doc['status'] == 'ready' and counts.get(doc['id'], 0) < doc.get('chunk_count', 0):
+                stale.append(doc['id'])
+        if stale:
+            await db.documents.update_many(
+                {"id": {"$in": stale}},
+                {"$set": {"status": "stale", "progress": 0.0, "error": "Vectors missing from the vector store"}}
+            )
+        
+        orphans = await remove_orphans(index, counts, {doc['id'] for doc in docs})
+        if stale or orphans:
+            logging.warning(f"Vector store of tenant {tenant} out of sync: {len(stale)} stale documents, "
+                            f"{len(orphans)} orphaned documents removed")
+        report["documents"] += len(docs)
+        report["stale"] += len(stale)
+        report["orphans_removed"] += len(orphans)
+    return report
+
+class ChunkBatchWriter:
+    """Buffers chunks across a tenant's documents and writes them to ChromaDB in large batches
+    
+    Documents are marked ready once their chunks have been written. A document
+    deleted in the meantime has left ingest_jobs: its chunks are not written,
+    or are removed again, and it is listed in `deleted` instead.
+    """
+
+    def __init__(self, index: TenantIndex, batch_size: int = BULK_BATCH_SIZE):
+        self.index = index
+        self.batch_size = batch_size
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.pending: Dict[str, int] = {}
+        self.deleted: set = set()
+
+    async def add(self, doc: dict, chunks: List[Chunk]):
+        self.ids.extend(f"{doc['id']}_{i}" for i in range(len(chunks)))
+        self.texts.extend(chunk.text for chunk in chunks)
+        self.metadatas.extend(chunk_metadata(doc, i, chunk) for i, chunk in enumerate(chunks))
+        self.pending[doc['id']] = len(chunks)
+        if len(self.ids) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        keep = [i for i, metadata in enumerate(self.metadatas) if metadata['document_id'] in ingest_jobs]
+        if keep:
+            await write_chunks(self.index, ids=[self.ids[i] for i in keep], documents=[self.texts[i] for i in keep],
+                               metadatas=[self.metadatas[i] for i in keep])
+        if self.pending:
+            await db.documents.bulk_write([
+                UpdateOne({"id": doc_id, "status": {"$ne": "deleting"}},
+                          {"$set": {"status": "ready", "progress": 1.0, "chunk_count": chunk_count, "error": None}})
+                for doc_id, chunk_count in self.pending.items()
+            ])
+        # Deleted while being written: the purge may have missed chunks written since, so drop them here
+        deleted = [doc_id for doc_id in self.pending if doc_id not in ingest_jobs]
+        if deleted:
+            await asyncio.get_running_loop().run_in_executor(vector_executor, delete_document_chunks, self.index, deleted)
+            self.deleted.update(deleted)
+        self.ids, self.texts, self.metadatas, self.pending = [], [], [], {}
+
+async def bulk_ingest(docs: List[dict]) -> Dict[str, dict]:
+    """Extract stored uploads in the process pool and write their chunks in large batches
+    
+    Returns a result per document ID with its status, chunk count and error.
+    Documents deleted while they were being ingested get the status `deleted`.
+    Run inside `ingesting`, which is how deletions signal the writers.
+    """
+    loop = asyncio.get_running_loop()
+    writers: Dict[str, ChunkBatchWriter] = {}  # one per tenant
+    results: Dict[str, dict] = {}
+    
+    async def extract(doc: dict):
+        path = stored_file_path(doc['id'], doc['file_type'])
+        try:
+            started = time.perf_counter()
+            chunks = await loop.run_in_executor(extract_pool, extract_file_chunks, str(path), doc['file_type'])
+            metrics.EXTRACTION_SECONDS.observe(time.perf_counter() - started, file_type=doc['file_type'])
+            metrics.UPLOAD_CHUNKS.observe(len(chunks), file_type=doc['file_type'])
+            return doc, chunks, None
+        except Exception as e:
+            return doc, None, e
+    
+    for next_result in asyncio.as_completed([extract(doc) for doc in docs]):
+        doc, chunks, error = await next_result
+        if doc['id'] not in ingest_jobs:
+            # Deleted while it was being extracted, possibly along with its upload
+            results[doc['id']] = {"status": "deleted", "chunk_count": 0}
+            continue
+        if error is not None:
+            logging.error(f"Error processing document {doc['id']}: {error}")
+            await update_document_status(doc['id'], status="failed", error=str(error))
+            results[doc['id']] = {"status": "failed", "chunk_count": 0, "error": str(error)}
+            continue
+        if doc['tenant_id'] not in writers:
+            writers[doc['tenant_id']] = ChunkBatchWriter(await get_tenant_index(doc['tenant_id']))
+        await writers[doc['tenant_id']].add(doc, chunks)
+        results[doc['id']] = {"status": "ready", "chunk_count": len(chunks)}
+    for writer in writers.values():
+        await writer.flush()
+        for doc_id in writer.deleted:
+            results[doc_id] = {"status": "deleted", "chunk_count": 0}
+    
+    return results
+
+async def reindex_documents(doc_ids: Optional[List[str]] = None, tenant: Optional[str] = None) -> dict:
+    """Rebuild vectors from stored uploads
+    
+    Reindexes every stale document, or the given documents when `doc_ids` is
+    set, of one tenant or, when `tenant` is None, of every tenant. Documents
+    without a stored upload, such as those loaded from a snapshot, are left
+    as they are and counted as not reindexable.
+    """
+    query = {"status": "stale"} if doc_ids is None else {"id": {"$in": doc_ids}, "status": {"$ne": "deleting"}}
+    if tenant:
+        query["tenant_id"] = tenant
+    docs = await db.documents.find(
+        query, {"_id": 0, "id": 1, "tenant_id": 1, "filename": 1, "file_type": 1, "created_at": 1}
+    ).to_list(None)
+    # Documents already being ingested are left to the job that has them
+    docs = [doc for doc in docs if doc['id'] not in ingest_jobs]
+    missing = await asyncio.get_running_loop().run_in_executor(cpu_executor, missing_uploads, docs)
+    if missing:
+        logging.warning(f"Not reindexing {len(missing)} documents without a stored upload")
+    docs = [doc for doc in docs if doc['id'] not in missing]
+    with ingesting([doc['id'] for doc in docs]):
+        results = await bulk_ingest(docs)
+        # Chunk IDs are reused, so only chunks past the new end can be left over
+        for doc in docs:
+            if results[doc['id']]['status'] == 'ready':
+                await asyncio.get_running_loop().run_in_executor(
+                    vector_executor, delete_chunks_from, await get_tenant_index(doc['tenant_id']),
+                    doc['id'], results[doc['id']]['chunk_count']
+                )
+    return {
+        "reindexed": sum(1 for r in results.values() if r['status'] == 'ready'),
+        "failed": sum(1 for r in results.values() if r['status'] == 'failed'),
+        "not_reindexable": len(missing)
+    }
+
+def missing_uploads(docs: List[dict]) -> set:
+    """IDs of the documents whose original upload is not in UPLOAD_DIR"""
+    return {doc['id'] for doc in docs if not stored_file_path(doc['id'], doc['file_type']).exists()}
+
+async def find_duplicate(tenant: str, digest: str) -> Optional[dict]:
+    """A tenant's existing document with identical content, unless its processing failed"""
+    return await db.documents.find_one(
+        {"tenant_id": tenant, "content_hash": digest, "status": {"$nin": ["failed", "deleting"]}}, {"_id": 0}
+    )
+
+def release_ingest_job(doc_id: str, job):
+    """Free a document's ingest_jobs entry, unless another job has taken it since"""
+    if ingest_jobs.get(doc_id) is job:
+        del ingest_jobs[doc_id]
+
+@contextlib.contextmanager
+def ingesting(doc_ids: List[str]):
+    """Register documents ingested by the current task in ingest_jobs for the duration of the block
+    
+    Reconciliation then leaves them alone while they are still `processing`.
+    """
+    job = asyncio.current_task()
+    for doc_id in doc_ids:
+        ingest_jobs[doc_id] = job
+    try:
+        yield
+    finally:
+        for doc_id in doc_ids:
+            release_ingest_job(doc_id, job)
+
+async def start_new_version(previous: dict, upload_path: Path, digest: str, size: int) -> dict:
+    """Replace a document's file with a changed upload and queue an incremental re-ingest"""
+    doc_id = previous['id']
+    if doc_id in ingest_jobs:
+        upload_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=409, detail=f"{previous['filename']} is still being processed")
+    # Claim the document before the first await, so a concurrent upload of it gets the 409 above
+    reservation = asyncio.get_running_loop().create_future()
+    ingest_jobs[doc_id] = reservation
+    try:
+        doc = await replace_document_file(previous, upload_path, digest, size)
+    except BaseException:
+        release_ingest_job(doc_id, reservation)
+        raise
+    if doc is None or ingest_jobs.get(doc_id) is not reservation:
+        # Deleted in the meantime
+        release_ingest_job(doc_id, reservation)
+        raise HTTPException(status_code=404, detail="Document not found")
+    answer_cache.invalidate_document(doc_id)
+    ingest_jobs[doc_id] = asyncio.create_task(
+        process_document(doc, replace=True)
+    )
+    return doc
+
+async def replace_document_file(previous: dict, upload_path: Path, digest: str, size: int) -> Optional[dict]:
+    """Move a changed upload into place and record the new version, unless the document is being deleted"""
+    doc_id = previous['id']
+    os.replace(upload_path, stored_file_path(doc_id, previous['file_type']))
+    
+    return await db.documents.find_one_and_update(
+        {"id": doc_id, "status": {"$ne": "deleting"}},
+        {
+            "$set": {"content_hash": digest, "file_size": size, "version": previous.get('version', 1) + 1,
+                     "status": "processing", "progress": 0.0, "error": None},
+            "$push": {"versions": {
+                "version": previous.get('version', 1),
+                "content_hash": previous.get('content_hash'),
+                "file_size": previous['file_size'],
+                "chunk_count": previous.get('chunk_count', 0),
+                "replaced_at": datetime.now(timezone.utc)
+            }}
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+# Deletion
+def document_chunk_ids(doc: dict) -> List[str]:
+    """Every ID a document's chunks can have, from the `{id}_{i}` scheme and its largest chunk count"""
+    count = max([doc.get('chunk_count', 0)] + [v.get('chunk_count', 0) for v in doc.get('versions', [])])
+    return [f"{doc['id']}_{i}" for i in range(count)]
+
+def delete_chunk_ids(index: TenantIndex, doc_ids: List[str], chunk_ids: List[str]):
+    """Delete chunks by ID in batches, then drop the documents from the keyword index"""
+    for start in range(0, len(chunk_ids), DELETE_BATCH_SIZE):
+        index.collection.delete(ids=chunk_ids[start:start + DELETE_BATCH_SIZE])
+    for doc_id in doc_ids:
+        index.keyword_index.remove_document(doc_id)
+    index.bump_version()
+
+async def purge_documents(index: TenantIndex, docs: List[dict]) -> List[str]:
+    """Second phase of deletion: remove a tenant's tombstoned documents' chunks, files and records
+    
+    Chunks are deleted by ID, without reading them first. If the vector store
+    fails, the tombstones are kept and the garbage collector tries again.
+    """
+    if not docs:
+        return []
+    doc_ids = [doc['id'] for doc in docs]
+    chunk_ids = [chunk_id for doc in docs for chunk_id in document_chunk_ids(doc)]
+    try:
+        await asyncio.get_running_loop().run_in_executor(vector_executor, delete_chunk_ids, index, doc_ids, chunk_ids)
+    except Exception as e:
+        logging.error(f"Error deleting chunks of {len(docs)} documents from ChromaDB: {e}")
+        await db.documents.update_many({"id": {"$in": doc_ids}}, {"$set": {"error": str(e)}})
+        return []
+    for doc in docs:
+        stored_file_path(doc['id'], doc['file_type']).unlink(missing_ok=True)
+    await db.documents.delete_many({"id": {"$in": doc_ids}, "status": "deleting"})
+    return doc_ids
+
+async def delete_documents_by_id(tenant: str, doc_ids: List[str]) -> DocumentDeleteResponse:
+    """Tombstone a tenant's documents, so they disappear at once, then purge them"""
+    doc_ids = list(dict.fromkeys(doc_ids))
+    owned = await db.documents.find({"tenant_id": tenant, "id": {"$in": doc_ids}}, {"_id": 0, "id": 1}).to_list(None)
+    for doc in owned:
+        # Signal a running ingestion job to stop and clean up after itself. This comes before the
+        # tombstone, so a job that still finds its entry afterwards has set chunk_count for the purge.
+        ingest_jobs.pop(doc['id'], None)
+    await db.documents.update_many(
+        {"tenant_id": tenant, "id": {"$in": doc_ids}},
+        {"$set": {"status": "deleting", "deleted_at": datetime.now(timezone.utc)}}
+    )
+    docs = await db.documents.find(
+        {"tenant_id": tenant, "id": {"$in": doc_ids}, "status": "deleting"},
+        {"_id": 0, "id": 1, "file_type": 1, "chunk_count": 1, "versions.chunk_count": 1}
+    ).to_list(None)
+    for doc in docs:
+        answer_cache.invalidate_document(doc['id'])
+    
+    purged = await purge_documents(await get_tenant_index(tenant), docs)
+    found = {doc['id'] for doc in docs}
+    return DocumentDeleteResponse(
+        deleted=purged,
+        not_found=[doc_id for doc_id in doc_ids if doc_id not in found],
+        pending=[doc_id for doc_id in doc_ids if doc_id in found and doc_id not in purged]
+    )
+
+async def collect_garbage(tenant: Optional[str] = None) -> dict:
+    """Retry tombstoned deletions, drop orphaned chunks and compact the keyword index
+    
+    Covers one tenant, or every tenant when `tenant` is None.
+    """
+    report = {"purged": 0, "still_deleting": 0, "orphans_removed": 0}
+    for tenant in [tenant] if tenant else await all_tenants():
+        index = await get_tenant_index(tenant)
+        tombstoned = await db.documents.find(
+            {"tenant_id": tenant, "status": "deleting"},
+            {"_id": 0, "id": 1, "file_type": 1, "chunk_count": 1, "versions.chunk_count": 1}
+        ).to_list(None)
+        purged = await purge_documents(index, tombstoned)
+        
+        counts = await asyncio.get_running_loop().run_in_executor(vector_executor, get_chunk_counts, index)
+        known = {doc['id'] for doc in await db.documents.find({"tenant_id": tenant}, {"_id": 0, "id": 1}).to_list(None)}
+        orphans = await remove_orphans(index, counts, known)
+        await asyncio.get_running_loop().run_in_executor(vector_executor, index.keyword_index.compact)
+        
+        metrics.GC_REMOVED.inc(len(purged), kind="tombstoned")
+        metrics.GC_REMOVED.inc(len(orphans), kind="orphaned")
+        report["purged"] += len(purged)
+        report["still_deleting"] += len(tombstoned) - len(purged)
+        report["orphans_removed"] += len(orphans)
+    return report
+
+async def run_garbage_collector():
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        try:
+            report = await collect_garbage()
+            if report["purged"] or report["still_deleting"] or report["orphans_removed"]:
+                logging.info(f"Garbage collection: {report}")
+        except Exception as e:
+            logging.error(f"Error collecting garbage: {e}")
+
+# Snapshots
+def embedding_model_key() -> str:
+    """Identifies the model vectors were computed with; a snapshot only loads into the same model"""
+    return f"{embedder.backend}:{embedder.model_name}"
+
+def export_chunks(index: TenantIndex, writer: SnapshotWriter, doc_ids: set):
+    """Copy a tenant's chunks of the given documents, with their vectors, into a snapshot"""
+    for page in scan_collection(index, ["documents", "metadatas", "embeddings"]):
+        keep = [i for i, metadata in enumerate(page['metadatas']) if metadata.get('document_id') in doc_ids]
+        if keep:
+            writer.add_chunks([page['ids'][i] for i in keep], [page['documents'][i] for i in keep],
+                              [page['metadatas'][i] for i in keep], [page['embeddings'][i] for i in keep])
+
+async def export_snapshot(tenant: str, path: Path) -> dict:
+    """Write a tenant's ready documents, their chunks and vectors to a snapshot file
+    
+    Original uploads are not included. Returns the snapshot's manifest.
+    """
+    loop = asyncio.get_running_loop()
+    with SnapshotWriter(embedding_model_key(), work_dir=str(UPLOAD_DIR)) as writer:
+        doc_ids = set()
+        docs = db.documents.find({"tenant_id": tenant, "status": "ready"}, {"_id": 0}).sort("created_at", 1)
+        async for doc in docs:
+            writer.add_document(DocumentModel(**doc).model_dump(mode="json", exclude={"tenant_id"}))
+            doc_ids.add(doc['id'])
+        await loop.run_in_executor(vector_executor, export_chunks, await get_tenant_index(tenant), writer, doc_ids)
+        return await loop.run_in_executor(cpu_executor, writer.write, path)
+
+async def import_snapshot(tenant: str, path: Path) -> dict:
+    """Load a snapshot into a tenant without extracting or embedding anything
+    
+    Documents whose content the tenant already has are skipped, with their
+    chunks. Documents whose ID is already in use get a new one. Imported
+    documents have no original upload, so they cannot be reindexed, but a
+    changed file can still be uploaded over them.
+    """
+    loop = asyncio.get_running_loop()
+    reader = await loop.run_in_executor(cpu_executor, functools.partial(SnapshotReader, path, work_dir=str(UPLOAD_DIR)))
+    with reader:
+        if reader.manifest.get("model") != embedding_model_key():
+            raise ValueError(f"Snapshot vectors come from {reader.manifest.get('model')}, "
+                             f"but this deployment embeds with {embedding_model_key()}")
+        documents = [DocumentModel.model_validate(record) for record in reader.documents()]
+        
+        hashes = [doc.content_hash for doc in documents if doc.content_hash]
+        existing = {doc['content_hash'] for doc in await db.documents.find(
+            {"tenant_id": tenant, "content_hash": {"$in": hashes}, "status": {"$nin": ["failed", "deleting"]}},
+            {"_id": 0, "content_hash": 1}
+        ).to_list(None)}
+        taken = {doc['id'] for doc in await db.documents.find(
+            {"id": {"$in": [doc.id for doc in documents]}}, {"_id": 0, "id": 1}
+        ).to_list(None)}
+        renamed: Dict[str, str] = {}  # snapshot document ID -> ID in this deployment
+        imported = []
+        for doc in documents:
+            if doc.content_hash in existing:
+                continue
+            if doc.content_hash:
+                existing.add(doc.content_hash)
+            renamed[doc.id] = str(uuid.uuid4()) if doc.id in taken else doc.id
+            imported.append(doc.model_copy(update={"id": renamed[doc.id], "tenant_id": tenant,
+                                                   "status": "processing", "progress": 0.0, "error": None}))
+        if not imported:
+            return {"documents": 0, "skipped": len(documents), "renamed": 0, "chunks": 0}
+        
+        # Records first, so the garbage collector never takes the new chunks for orphans
+        with ingesting([doc.id for doc in imported]):
+            await db.documents.insert_many([doc.model_dump() for doc in imported])
+            index = await get_tenant_index(tenant)
+            batches = reader.chunks(BULK_BATCH_SIZE)
+            chunks: Counter = Counter()  # written per document ID
+            try:
+                while batch := await loop.run_in_executor(cpu_executor, next, batches, None):
+                    ids, texts, metadatas, vectors = batch
+                    # Chunks of documents deleted during the import are not written
+                    keep = [i for i, metadata in enumerate(metadatas)
+                            if renamed.get(metadata.get('document_id')) in ingest_jobs]
+                    for i in keep:
+                        old_id = metadatas[i]['document_id']
+                        metadatas[i]['document_id'] = renamed[old_id]
+                        ids[i] = renamed[old_id] + ids[i][len(old_id):]
+                    if keep:
+                        await write_chunks(index, [ids[i] for i in keep], [texts[i] for i in keep],
+                                           [metadatas[i] for i in keep], embeddings=list(vectors[keep]))
+                        chunks.update(metadatas[i]['document_id'] for i in keep)
+            except Exception as e:
+                logging.error(f"Error importing snapshot chunks: {e}")
+                await db.documents.update_many(
+                    {"id": {"$in": [doc.id for doc in imported]}, "status": {"$ne": "deleting"}},
+                    {"$set": {"status": "failed", "error": str(e)}}
+                )
+                raise
+            await db.documents.update_many(
+                {"id": {"$in": [doc.id for doc in imported]}, "status": {"$ne": "deleting"}},
+                {"$set": {"status": "ready", "progress": 1.0}}
+            )
+            # Deleted while their chunks were being written: the purge may have missed some
+            deleted = [doc.id for doc in imported if doc.id not in ingest_jobs]
+            if deleted:
+                await loop.run_in_executor(vector_executor, delete_document_chunks, index, deleted)
+        return {
+            "documents": len(imported) - len(deleted),
+            "skipped": len(documents) - len(imported),
+            "renamed": sum(1 for old_id, new_id in renamed.items() if old_id != new_id),
+            "chunks": sum(count for doc_id, count in chunks.items() if doc_id not in deleted)
+        }
+
+# Pagination
+def encode_cursor(doc: dict, field: str) -> str:
+    """Opaque keyset cursor: the sort field and ID of the last item on a page"""
+    raw = json.dumps([doc[field].isoformat(), doc['id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(value), item_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def find_page(mongo_collection, query: dict, field: str, descending: bool, limit: int,
+                    cursor: Optional[str], response: Response) -> List[dict]:
+    """Fetch one page ordered by (`field`, id), continuing after `cursor`
+    
+    The cursor for the next page, if there is one, is returned in the
+    X-Next-Cursor header.
+    """
+    if cursor:
+        value, item_id = decode_cursor(cursor)
+        op = "$lt" if descending else "$gt"
+        query = {"$and": [query, {"$or": [
+            {field: {op: value}},
+            {field: value, "id": {op: item_id}}
+        ]}]}
+    direction = -1 if descending else 1
+    items = await mongo_collection.find(query, {"_id": 0}).sort(
+        [(field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(None)
+    if len(items) > limit:
+        items = items[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(items[-1], field)
+    return items
 
 # Document endpoints
 @api_router.post("/documents/upload", response_model=DocumentModel)
-async def upload_document(file: UploadFile = File(...)):
-    """Upload and process a document"""
+async def upload_document(file: UploadFile = File(...), tenant: str = Depends(get_tenant)):
+    """Upload a document and queue it for processing
+    
+    A file identical to one already uploaded returns the existing document. A
+    changed file uploaded under an existing name becomes a new version of that
+    document, and only its changed chunks are re-embedded.
+    """
     # Validate file type
-    allowed_types = {'.pdf', '.txt', '.md', '.docx'}
     file_ext = Path(file.filename).suffix.lower()
     
-    if file_ext not in allowed_types:
-        raise HTTPException(status_code=400, detail=f"File type {file_ext} not supported. Allowed: {allowed_types}")
+    if file_ext not in ALLOWED_TYPES:
+        raise HTTPException(status_code=400, detail=f"File type {file_ext} not supported. Allowed: {ALLOWED_TYPES}")
     
-    # Read file content
-    content = await file.read()
-    file_size = len(content)
+    # Stream the file to disk
+    upload_path, digest, size = await save_upload(file)
     
-    # Extract text based on file type
-    if file_ext == '.pdf':
-        text = extract_text_from_pdf(content)
-    elif file_ext == '.docx':
-        text = extract_text_from_docx(content)
-    else:
-        text = extract_text_from_txt(content)
+    duplicate = await find_duplicate(tenant, digest)
+    if duplicate:
+        upload_path.unlink(missing_ok=True)
+        return duplicate
+    previous = await db.documents.find_one(
+        {"tenant_id": tenant, "filename": file.filename, "status": {"$ne": "deleting"}}, {"_id": 0}
+    )
+    if previous:
+        return await start_new_version(previous, upload_path, digest, size)
     
     # Create document record
-    doc_id = str(uuid.uuid4())
     document = DocumentModel(
-        id=doc_id,
+        tenant_id=tenant,
         filename=file.filename,
         file_type=file_ext,
-        file_size=file_size,
-        status="processing"
+        file_size=size,
+        status="processing",
+        content_hash=digest
     )
+    os.replace(upload_path, stored_file_path(document.id, file_ext))
     
-    # Chunk the text
-    chunks = chunk_text(text)
-    document.chunk_count = len(chunks)
+    # Register the job before the record exists, so reconciliation never sees it `processing` without one
+    reservation = asyncio.get_running_loop().create_future()
+    ingest_jobs[document.id] = reservation
+    try:
+        await db.documents.insert_one(document.model_dump())
+    except BaseException:
+        release_ingest_job(document.id, reservation)
+        raise
     
-    if chunks:
-        # Add to ChromaDB with metadata
-        chunk_ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
-        metadatas = [{"document_id": doc_id, "filename": file.filename, "chunk_index": i} for i in range(len(chunks))]
-        
-        collection.add(
-            ids=chunk_ids,
-            documents=chunks,
-            metadatas=metadatas
+    # Extraction, chunking and embedding happen in the background; poll /documents/{id}/status
+    if ingest_jobs.get(document.id) is reservation:
+        ingest_jobs[document.id] = asyncio.create_task(
+            process_document(document.model_dump())
         )
     
-    document.status = "ready"
+    return document
+
+@api_router.post("/documents/upload/batch", response_model=BatchUploadResponse)
+async def upload_documents(files: List[UploadFile] = File(...), tenant: str = Depends(get_tenant)):
+    """Upload many documents, or zip archives of documents, and process them together"""
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    results: List[dict] = []
+    documents: List[DocumentModel] = []
+    seen: Dict[str, str] = {}  # content hash -> document ID, for duplicates within the batch
+    total_bytes = 0
+    members: List[tuple] = []
+    
+    try:
+        for file in files:
+            upload_path, digest, size = await save_upload(file)
+            if Path(file.filename).suffix.lower() == '.zip':
+                try:
+                    members = await loop.run_in_executor(
+                        cpu_executor, extract_archive, upload_path, str(UPLOAD_DIR), MAX_ARCHIVE_MEMBER_SIZE
+                    )
+                except Exception as e:
+                    # Corrupt, encrypted or oversized archives and unsupported compression methods
+                    results.append({"filename": file.filename, "status": "failed", "error": str(e) or type(e).__name__})
+                    continue
+                finally:
+                    upload_path.unlink(missing_ok=True)
+                members = [(filename, Path(path), None) for filename, path in members]
+            else:
+                members = [(file.filename, upload_path, digest)]
+            
+            for filename, member_path, digest in members:
+                file_ext = Path(filename).suffix.lower()
+                if file_ext not in ALLOWED_TYPES:
+                    member_path.unlink(missing_ok=True)
+                    results.append({"filename": filename, "status": "failed", "error": f"File type {file_ext} not supported"})
+                    continue
+                if digest is None:
+                    digest = await loop.run_in_executor(cpu_executor, hash_file, member_path)
+                size = member_path.stat().st_size
+                duplicate = seen.get(digest) or (await find_duplicate(tenant, digest) or {}).get('id')
+                if duplicate:
+                    member_path.unlink(missing_ok=True)
+                    results.append({"filename": filename, "document_id": duplicate, "status": "duplicate"})
+                    continue
+                previous = await db.documents.find_one(
+                    {"tenant_id": tenant, "filename": filename, "status": {"$ne": "deleting"}}, {"_id": 0}
+                )
+                if previous:
+                    # Changed version of an existing document: re-ingested incrementally in the background
+                    try:
+                        await start_new_version(previous, member_path, digest, size)
+                    except HTTPException as e:
+                        results.append({"filename": filename, "document_id": previous['id'], "status": "failed", "error": e.detail})
+                        continue
+                    seen[digest] = previous['id']
+                    results.append({"filename": filename, "document_id": previous['id'], "status": "processing"})
+                    total_bytes += size
+                    continue
+                document = DocumentModel(tenant_id=tenant, filename=filename, file_type=file_ext, file_size=size,
+                                         content_hash=digest)
+                seen[digest] = document.id
+                os.replace(member_path, stored_file_path(document.id, file_ext))
+                documents.append(document)
+                results.append({"filename": filename, "document_id": document.id, "status": "processing"})
+                total_bytes += size
+    except BaseException:
+        # Neither files already moved into place nor members still waiting have a record yet
+        for document in documents:
+            stored_file_path(document.id, document.file_type).unlink(missing_ok=True)
+        for _, member_path, _ in members:
+            member_path.unlink(missing_ok=True)
+        raise
     
-    # Save to MongoDB
-    doc_dict = document.model_dump()
-    doc_dict['created_at'] = doc_dict['created_at'].isoformat()
-    await db.documents.insert_one(doc_dict)
+    if documents:
+        with ingesting([document.id for document in documents]):
+            await db.documents.insert_many([document.model_dump() for document in documents])
+            ingested = await bulk_ingest([document.model_dump() for document in documents])
+        for result in results:
+            # Duplicates within the batch share the document ID of the copy that was ingested
+            if result['status'] == 'processing' and result.get('document_id') in ingested:
+                result.update(ingested[result['document_id']])
     
-    return document
+    seconds = time.perf_counter() - started
+    ready = [r for r in results if r['status'] == 'ready']
+    chunks = sum(r['chunk_count'] for r in ready)
+    return BatchUploadResponse(
+        results=results,
+        files=len(results),
+        ready=len(ready),
+        failed=sum(1 for r in results if r['status'] == 'failed'),
+        duplicates=sum(1 for r in results if r['status'] == 'duplicate'),
+        chunks=chunks,
+        bytes=total_bytes,
+        seconds=round(seconds, 3),
+        files_per_second=round(len(results) / seconds, 2) if seconds else 0.0,
+        chunks_per_second=round(chunks / seconds, 2) if seconds else 0.0
+    )
+
+@api_router.post("/documents/reindex")
+async def reindex(tenant: str = Depends(get_tenant)):
+    """Reconcile MongoDB with the vector store and rebuild missing vectors"""
+    report = await reconcile_vector_store(tenant)
+    report.update(await reindex_documents(tenant=tenant))
+    return report
+
+@api_router.get("/documents/{doc_id}/status", response_model=DocumentStatus)
+async def get_document_status(doc_id: str, tenant: str = Depends(get_tenant)):
+    """Get processing status of a document"""
+    doc = await db.documents.find_one(
+        {"tenant_id": tenant, "id": doc_id, "status": {"$ne": "deleting"}},
+        {"_id": 0, "id": 1, "status": 1, "progress": 1, "chunk_count": 1, "error": 1}
+    )
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return doc
 
 @api_router.get("/documents", response_model=List[DocumentModel])
-async def get_documents():
-    """Get all documents"""
-    documents = await db.documents.find({}, {"_id": 0}).to_list(1000)
-    for doc in documents:
-        if isinstance(doc['created_at'], str):
-            doc['created_at'] = datetime.fromisoformat(doc['created_at'])
-    return documents
+async def get_documents(response: Response, cursor: Optional[str] = None,
+                        limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), tenant: str = Depends(get_tenant)):
+    """Get documents, newest first, one page at a time"""
+    return await find_page(db.documents, {"tenant_id": tenant, "status": {"$ne": "deleting"}}, "created_at", True,
+                           limit, cursor, response)
+
+@api_router.post("/documents/delete", response_model=DocumentDeleteResponse)
+async def delete_documents(request: DocumentDeleteRequest, tenant: str = Depends(get_tenant)):
+    """Delete many documents and their chunks"""
+    return await delete_documents_by_id(tenant, request.ids)
 
 @api_router.delete("/documents/{doc_id}")
-async def delete_document(doc_id: str):
+async def delete_document(doc_id: str, tenant: str = Depends(get_tenant)):
     """Delete a document and its chunks"""
-    # Delete from MongoDB
-    result = await db.documents.delete_one({"id": doc_id})
-    if result.deleted_count == 0:
+    result = await delete_documents_by_id(tenant, [doc_id])
+    if result.not_found:
         raise HTTPException(status_code=404, detail="Document not found")
-    
-    # Delete chunks from ChromaDB
-    try:
-        # Get all chunks for this document
-        results = collection.get(where={"document_id": doc_id})
-        if results['ids']:
-            collection.delete(ids=results['ids'])
-    except Exception as e:
-        logging.error(f"Error deleting chunks from ChromaDB: {e}")
-    
     return {"message": "Document deleted"}
 
+@api_router.post("/documents/gc")
+async def garbage_collect(tenant: str = Depends(get_tenant)):
+    """Retry failed deletions, drop orphaned chunks and compact the keyword index"""
+    return await collect_garbage(tenant)
 
+@api_router.get("/documents/export")
+async def export_documents(tenant: str = Depends(get_tenant)):
+    """Download the ready documents as a snapshot: records, chunk text, metadata and vectors"""
+    fd, name = tempfile.mkstemp(dir=UPLOAD_DIR, suffix='.tar')
+    os.close(fd)
+    path = Path(name)
+    try:
+        await export_snapshot(tenant, path)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return FileResponse(path, media_type="application/x-tar", filename=f"knowledge-base-{tenant}.tar",
+                        background=BackgroundTask(path.unlink, missing_ok=True))
+
+@api_router.post("/documents/import")
+async def import_documents(file: UploadFile = File(...), tenant: str = Depends(get_tenant)):
+    """Load a snapshot from /documents/export without re-extracting or re-embedding it"""
+    upload_path, _, _ = await save_upload(file)
+    try:
+        return await import_snapshot(tenant, upload_path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        upload_path.unlink(missing_ok=True)
 
 # Conversation endpoints
 @api_router.post("/conversations", response_model=Conversation)
-async def create_conversation():
-    """Create a new conversation"""
-    conversation = Conversation()
-    conv_dict = conversation.model_dump()
-    conv_dict['created_at'] = conv_dict['created_at'].isoformat()
-    conv_dict['updated_at'] = conv_dict['updated_at'].isoformat()
-    await db.conversations.insert_one(conv_dict)
+async def create_conversation(request: Optional[ConversationCreate] = None, tenant: str = Depends(get_tenant)):
+    """Create a new conversation, optionally scoped to a subset of documents"""
+    conversation = Conversation(tenant_id=tenant, **(request.model_dump() if request else {}))
+    await db.conversations.insert_one(conversation.model_dump())
     return conversation
 
 @api_router.get("/conversations", response_model=List[Conversation])
-async def get_conversations():
-    """Get all conversations"""
-    conversations = await db.conversations.find({}, {"_id": 0}).sort("updated_at", -1).to_list(100)
-    for conv in conversations:
-        if isinstance(conv['created_at'], str):
-            conv['created_at'] = datetime.fromisoformat(conv['created_at'])
-        if isinstance(conv['updated_at'], str):
-            conv['updated_at'] = datetime.fromisoformat(conv['updated_at'])
-    return conversations
+async def get_conversations(response: Response, cursor: Optional[str] = None,
+                            limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), tenant: str = Depends(get_tenant)):
+    """Get conversations, most recently updated first, one page at a time"""
+    return await find_page(db.conversations, {"tenant_id": tenant}, "updated_at", True, limit, cursor, response)
 
 @api_router.get("/conversations/{conv_id}", response_model=Conversation)
-async def get_conversation(conv_id: str):
+async def get_conversation(conv_id: str, tenant: str = Depends(get_tenant)):
     """Get a single conversation"""
-    conv = await db.conversations.find_one({"id": conv_id}, {"_id": 0})
+    conv = await db.conversations.find_one({"tenant_id": tenant, "id": conv_id}, {"_id": 0})
+    if not conv:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conv
+
+@api_router.put("/conversations/{conv_id}/filters", response_model=Conversation)
+async def update_conversation_filters(conv_id: str, filters: Optional[RetrievalFilter] = None,
+                                      tenant: str = Depends(get_tenant)):
+    """Set or, with an empty body, clear the retrieval filter of a conversation"""
+    conv = await db.conversations.find_one_and_update(
+        {"tenant_id": tenant, "id": conv_id},
+        {"$set": {"filters": filters.model_dump() if filters else None}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    if isinstance(conv['created_at'], str):
-        conv['created_at'] = datetime.fromisoformat(conv['created_at'])
-    if isinstance(conv['updated_at'], str):
-        conv['updated_at'] = datetime.fromisoformat(conv['updated_at'])
     return conv
 
 @api_router.delete("/conversations/{conv_id}")
-async def delete_conversation(conv_id: str):
+async def delete_conversation(conv_id: str, tenant: str = Depends(get_tenant)):
     """Delete a conversation and its messages"""
-    result = await db.conversations.delete_one({"id": conv_id})
+    await turn_writer.wait_for(conv_id)
+    result = await db.conversations.delete_one({"tenant_id": tenant, "id": conv_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    await db.messages.delete_many({"conversation_id": conv_id})
+    await db.messages.delete_many({"tenant_id": tenant, "conversation_id": conv_id})
     return {"message": "Conversation deleted"}
 
 @api_router.get("/conversations/{conv_id}/messages", response_model=List[Message])
-async def get_messages(conv_id: str):
-    """Get messages for a conversation"""
-    messages = await db.messages.find({"conversation_id": conv_id}, {"_id": 0}).sort("created_at", 1).to_list(1000)
-    for msg in messages:
-        if isinstance(msg['created_at'], str):
-            msg['created_at'] = datetime.fromisoformat(msg['created_at'])
-    return messages
+async def get_messages(conv_id: str, response: Response, cursor: Optional[str] = None,
+                       limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), tenant: str = Depends(get_tenant)):
+    """Get messages for a conversation, oldest first, one page at a time"""
+    await turn_writer.wait_for(conv_id)
+    return await find_page(db.messages, {"tenant_id": tenant, "conversation_id": conv_id}, "created_at", False,
+                           limit, cursor, response)
 
-# Chat endpoint with RAG
-@api_router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """Send a message and get AI response with RAG"""
-    # Save user message
-    user_message = Message(
-        conversation_id=request.conversation_id,
-        role="user",
-        content=request.message
+def message_markdown(msg: dict) -> str:
+    """A message as a Markdown section, with its sources listed under answers"""
+    speaker = "You" if msg['role'] == 'user' else "Assistant"
+    text = f"**{speaker}** ({as_utc(msg['created_at']).strftime('%Y-%m-%d %H:%M UTC')})\n\n{msg['content']}\n\n"
+    sources = [f"{s.get('filename', 'Unknown')}, {page_label(s)}" if s.get('page') else s.get('filename', 'Unknown')
+               for s in msg.get('sources', [])]
+    if sources:
+        text += "Sources: " + "; ".join(dict.fromkeys(sources)) + "\n\n"
+    return text
+
+@api_router.get("/conversations/{conv_id}/export")
+async def export_conversation(conv_id: str, export_format: str = Query("json", alias="format", pattern="^(json|markdown)$"),
+                              tenant: str = Depends(get_tenant)):
+    """Download a conversation with all its messages, as JSON or Markdown
+    
+    Messages are streamed from MongoDB as they are read.
+    """
+    await turn_writer.wait_for(conv_id)
+    conv = await db.conversations.find_one({"tenant_id": tenant, "id": conv_id}, {"_id": 0})
+    if not conv:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    messages = db.messages.find({"tenant_id": tenant, "conversation_id": conv_id}, {"_id": 0}).sort(
+        [("created_at", 1), ("id", 1)]
     )
-    user_msg_dict = user_message.model_dump()
-    user_msg_dict['created_at'] = user_msg_dict['created_at'].isoformat()
-    await db.messages.insert_one(user_msg_dict)
     
-    # Search for relevant chunks
-    sources = []
-    context = ""
+    async def markdown():
+        yield f"# {conv['title']}\n\n"
+        async for msg in messages:
+            yield message_markdown(msg)
     
-    try:
-        results = collection.query(
-            query_texts=[request.message],
-            n_results=5
-        )
-        
-        if results['documents'] and results['documents'][0]:
-            for i, (doc, metadata) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
-                sources.append({
-                    "content": doc[:300] + "..." if len(doc) > 300 else doc,
-                    "filename": metadata.get('filename', 'Unknown'),
-                    "chunk_index": metadata.get('chunk_index', 0)
-                })
-                context += f"\n[Source {i+1} - {metadata.get('filename', 'Unknown')}]:\n{doc}\n"
-    except Exception as e:
-        logging.error(f"Error querying ChromaDB: {e}")
+    async def document():
+        yield '{"conversation": ' + Conversation(**conv).model_dump_json() + ', "messages": ['
+        separator = ""
+        async for msg in messages:
+            yield separator + Message(**msg).model_dump_json()
+            separator = ", "
+        yield "]}"
+    
+    extension, media_type = ("md", "text/markdown") if export_format == "markdown" else ("json", "application/json")
+    return StreamingResponse(
+        markdown() if export_format == "markdown" else document(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="conversation-{conv_id}.{extension}"'}
+    )
+
+# Answer cache
+def normalize_question(question: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?!. ")
+
+class AnswerCache:
+    """LRU cache of LLM answers keyed on the normalized question and retrieved chunk IDs
     
-    # Generate response with LLM
-    system_prompt = """You are a knowledgeable assistant that helps users understand their documents. 
+    Exact lookups match the normalized question. When a similarity threshold is
+    set, a question whose embedding is close enough to a cached question that
+    was answered from the same chunks is also served from the cache. Lookups
+    may embed the question, so call `get` and `put` off the event loop.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, similarity: float = 0.0,
+                 embed: Optional[Callable[[str], np.ndarray]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._embed = embed if similarity > 0 else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _embedding(self, question: str):
+        vector = np.asarray(self._embed(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _expired(self, entry: dict) -> bool:
+        return time.monotonic() - entry["created"] > self.ttl
+
+    def get(self, question: str, chunk_ids: List[str]) -> Optional[str]:
+        if not self.enabled or not chunk_ids:
+            return None
+        chunk_key = frozenset(chunk_ids)
+        key = (normalize_question(question), chunk_key)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and self._expired(entry):
+                del self.entries[key]
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["answer"]
+        
+        if self._embed is not None:
+            query = self._embedding(key[0])
+            with self._lock:
+                for other_key, other in reversed(self.entries.items()):
+                    if other_key[1] != chunk_key or self._expired(other):
+                        continue
+                    if float(np.dot(query, other["embedding"])) >= self.similarity:
+                        self.entries.move_to_end(other_key)
+                        self.similar_hits += 1
+                        return other["answer"]
+        
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, question: str, chunk_ids: List[str], answer: str, sources: List[dict]):
+        if not self.enabled or not chunk_ids:
+            return
+        normalized = normalize_question(question)
+        entry = {
+            "answer": answer,
+            "document_ids": {s.get("document_id") for s in sources},
+            "embedding": self._embedding(normalized) if self._embed is not None else None,
+            "created": time.monotonic()
+        }
+        with self._lock:
+            self.entries[(normalized, frozenset(chunk_ids))] = entry
+            self.entries.move_to_end((normalized, frozenset(chunk_ids)))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate_document(self, doc_id: str):
+        """Drop every answer that used a chunk from the given document"""
+        with self._lock:
+            for key in [k for k, v in self.entries.items() if doc_id in v["document_ids"]]:
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.similar_hits) / lookups if lookups else 0.0
+            }
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with hit and miss counters"""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[object, object]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+# Query vectors by normalized question; search results by tenant, normalized question,
+# filter, candidate count and the tenant's corpus version, so ingestion never serves stale hits
+query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE)
+
+answer_cache = AnswerCache(
+    max_entries=int(os.environ.get('ANSWER_CACHE_SIZE', '1000')),
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL', '3600')),
+    similarity=float(os.environ.get('ANSWER_CACHE_SIMILARITY', '0')),
+    embed=lambda question: embed_queries([question])[0]
+)
+
+# Chat helpers
+SYSTEM_PROMPT = """You are a knowledgeable assistant that helps users understand their documents. 
 When answering questions:
 1. Use the provided context from the knowledge base to answer
 2. If the context contains relevant information, cite the source by mentioning which document it came from
@@ -306,77 +1588,776 @@ When answering questions:
 4. Be concise but thorough in your explanations
 5. Format your response clearly with proper paragraphs"""
 
+def get_chat_model():
+    """Create the chat model used for answers, with a pooled HTTP client
+    
+    Retries are handled by `llm` so they count against its concurrency limit.
+    """
+    return ChatOpenAI(
+        model="gpt-4.1-mini",   # or gpt-4.1
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        temperature=0.7,
+        timeout=LLM_TIMEOUT,
+        max_retries=0,
+        http_async_client=httpx.AsyncClient(
+            timeout=LLM_TIMEOUT,
+            limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY)
+        )
+    )
+
+llm = ChatClient(get_chat_model, max_concurrency=LLM_MAX_CONCURRENCY, max_retries=LLM_MAX_RETRIES)
+
+async def write_turns(turns: List[tuple]):
+    """Persist chat turns, given as (conversation_id, messages, title), in two round trips
+    
+    All messages go in one insert and every conversation is touched in one
+    bulk write; `title` is only set on a conversation's first turn.
+    """
+    await db.messages.insert_many(
+        [message.model_dump() for _, messages, _ in turns for message in messages], ordered=False
+    )
+    now = datetime.now(timezone.utc)
+    await db.conversations.bulk_write([
+        UpdateOne({"tenant_id": messages[0].tenant_id, "id": conversation_id},
+                  {"$set": {"updated_at": now, **({"title": title} if title else {})}})
+        for conversation_id, messages, title in turns
+    ], ordered=False)
+
+class TurnWriter:
+    """Write-behind queue for chat turns
+    
+    Turns are written in batches by one background task, so a response does
+    not wait on MongoDB. Reads of a conversation call `wait_for` first so they
+    see its own turns. Turns still queued when the process dies are lost.
+    """
+    
+    def __init__(self, max_batch: int = WRITE_BEHIND_BATCH, max_attempts: int = 3):
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pending: Dict[str, int] = {}  # conversation_id -> turns not yet written
+        self.written = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+    
+    def submit(self, conversation_id: str, messages: List[Message], title: Optional[str] = None):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        self.pending[conversation_id] = self.pending.get(conversation_id, 0) + 1
+        self.queue.put_nowait((conversation_id, messages, title))
+        metrics.WRITE_BEHIND_PENDING.set(self.queue.qsize())
+    
+    async def run(self):
+        while True:
+            turns = [await self.queue.get()]
+            while len(turns) < self.max_batch and not self.queue.empty():
+                turns.append(self.queue.get_nowait())
+            metrics.WRITE_BEHIND_PENDING.set(self.queue.qsize())
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    with span("write_behind", turns=len(turns)):
+                        await write_turns(turns)
+                    break
+                except Exception as e:
+                    logging.error(f"Error writing {len(turns)} chat turns (attempt {attempt}): {e}")
+                    if attempt < self.max_attempts:
+                        await asyncio.sleep(0.5 * attempt)
+            for conversation_id, _, _ in turns:
+                self.pending[conversation_id] -= 1
+                if not self.pending[conversation_id]:
+                    del self.pending[conversation_id]
+                self.queue.task_done()
+            async with self.written:
+                self.written.notify_all()
+    
+    async def wait_for(self, conversation_id: str):
+        """Wait until every queued turn of a conversation has been written"""
+        async with self.written:
+            await self.written.wait_for(lambda: conversation_id not in self.pending)
+    
+    async def close(self):
+        """Write everything still queued, then stop"""
+        if self.task is not None:
+            await self.queue.join()
+            self.task.cancel()
+
+turn_writer = TurnWriter()
+
+def overlap_length(first: str, second: str) -> int:
+    """Length of the longest suffix of `first` that is also a prefix of `second`
+    
+    Overlaps shorter than 32 characters are not worth trimming and are ignored.
+    """
+    probe = second[:32]
+    if len(probe) < 32:
+        return 0
+    pos = first.find(probe, max(0, len(first) - len(second)))
+    while pos != -1:
+        if second.startswith(first[pos:]):
+            return len(first) - pos
+        pos = first.find(probe, pos + 1)
+    return 0
+
+def pack_context(ids: List[str], documents: List[str], metadatas: List[dict],
+                 budget: int = CONTEXT_TOKEN_BUDGET, scores: Optional[List[float]] = None) -> RetrievedContext:
+    """Pack retrieved chunks, best first, into at most `budget` context tokens
+    
+    Neighbouring chunks of the same document share their overlap; the repeated
+    text is trimmed from whichever of the two is added second, and chunks with
+    nothing new are skipped. Chunks that do not fit are skipped in favour of
+    lower-ranked ones that do. Reranking `scores`, when given, are included in
+    the sources.
+    """
+    result = RetrievedContext(usage=PromptUsage(chunks_retrieved=len(ids)))
+    selected: Dict[tuple, str] = {}  # (document_id, chunk_index) -> text used
+    seen_texts = set()
+    
+    for position, (chunk_id, doc, metadata) in enumerate(zip(ids, documents, metadatas)):
+        doc_id = metadata.get('document_id')
+        index = metadata.get('chunk_index', 0)
+        text = doc
+        if (doc_id, index - 1) in selected:
+            text = text[overlap_length(selected[(doc_id, index - 1)], text):]
+        if (doc_id, index + 1) in selected:
+            text = text[:len(text) - overlap_length(text, selected[(doc_id, index + 1)])]
+        if not text.strip() or text in seen_texts:
+            continue
+        
+        filename = metadata.get('filename', 'Unknown')
+        location = f", {page_label(metadata)}" if metadata.get('page') else ""
+        entry = f"\n[Source {len(result.sources) + 1} - {filename}{location}]:\n{text.strip()}\n"
+        tokens = count_tokens(entry)
+        if result.usage.context_tokens + tokens > budget:
+            continue
+        
+        selected[(doc_id, index)] = text
+        seen_texts.add(text)
+        result.chunk_ids.append(chunk_id)
+        source = {
+            "content": doc[:300] + "..." if len(doc) > 300 else doc,
+            "filename": filename,
+            "chunk_index": index,
+            "document_id": doc_id,
+            "page": metadata.get('page'),
+            "page_end": metadata.get('page_end')
+        }
+        if scores is not None:
+            source["score"] = round(scores[position], 4)
+        result.sources.append(source)
+        result.context += entry
+        result.usage.context_tokens += tokens
+    
+    result.usage.chunks_used = len(result.chunk_ids)
+    return result
+
+def run_traced(fn, *args, **kwargs):
+    """Bind a call to the current context so spans in worker threads keep the request ID"""
+    return functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def normalize_file_type(file_type: str) -> str:
+    file_type = file_type.lower()
+    return file_type if file_type.startswith('.') else f".{file_type}"
+
+def build_where(filters: Optional[RetrievalFilter]) -> Optional[dict]:
+    """ChromaDB `where` clause for a retrieval filter, or None to search everything"""
+    if filters is None:
+        return None
+    clauses = []
+    if filters.document_ids is not None:
+        clauses.append({"document_id": {"$in": filters.document_ids}})
+    if filters.file_types is not None:
+        clauses.append({"file_type": {"$in": [normalize_file_type(t) for t in filters.file_types]}})
+    if filters.uploaded_after is not None:
+        clauses.append({"uploaded_at": {"$gte": int(as_utc(filters.uploaded_after).timestamp())}})
+    if filters.uploaded_before is not None:
+        clauses.append({"uploaded_at": {"$lte": int(as_utc(filters.uploaded_before).timestamp())}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def build_document_query(filters: RetrievalFilter) -> dict:
+    """The same filter as a MongoDB query over documents"""
+    query = {}
+    if filters.document_ids is not None:
+        query["id"] = {"$in": filters.document_ids}
+    if filters.file_types is not None:
+        query["file_type"] = {"$in": [normalize_file_type(t) for t in filters.file_types]}
+    created_at = {}
+    if filters.uploaded_after is not None:
+        created_at["$gte"] = as_utc(filters.uploaded_after)
+    if filters.uploaded_before is not None:
+        created_at["$lte"] = as_utc(filters.uploaded_before)
+    if created_at:
+        query["created_at"] = created_at
+    return query
+
+async def filtered_document_ids(tenant: str, filters: Optional[RetrievalFilter]) -> Optional[set]:
+    """IDs of the tenant's documents a filter selects, or None when it selects everything"""
+    if build_where(filters) is None:
+        return None
+    if filters.document_ids is not None and filters.file_types is None \
+            and filters.uploaded_after is None and filters.uploaded_before is None:
+        return set(filters.document_ids)
+    docs = await db.documents.find(
+        {"tenant_id": tenant, **build_document_query(filters)}, {"_id": 0, "id": 1}
+    ).to_list(None)
+    return {doc['id'] for doc in docs}
+
+def embed_queries(questions: List[str]) -> List[np.ndarray]:
+    """Query vectors, from the cache where possible; the rest are embedded in one batch"""
+    keys = [normalize_question(question) for question in questions]
+    vectors = [query_embedding_cache.get(key) for key in keys]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        for i, vector in zip(missing, embedder.encode([questions[i] for i in missing])):
+            vectors[i] = vector
+            query_embedding_cache.put(keys[i], vector)
+    return vectors
+
+def traced_embed_queries(questions: List[str]) -> List[np.ndarray]:
+    with span("query_embedding", queries=len(questions)):
+        return embed_queries(questions)
+
+def vector_search(index: TenantIndex, embeddings: List[np.ndarray], n_results: int,
+                  where: Optional[dict] = None) -> List[dict]:
+    """Nearest chunks to each query vector in a tenant's collection, among those matching `where`"""
+    with span("chroma_query", tenant=index.tenant, queries=len(embeddings), filtered=where is not None):
+        results = index.collection.query(query_embeddings=embeddings, n_results=n_results, where=where)
+    return [
+        {chunk_id: (doc, metadata) for chunk_id, doc, metadata in zip(ids, documents, metadatas)}
+        for ids, documents, metadatas in zip(results['ids'], results['documents'], results['metadatas'])
+    ]
+
+async def search_vectors(index: TenantIndex, questions: List[str], n_results: int,
+                         where: Optional[dict] = None) -> List[dict]:
+    """Embed the questions in one batch on the query pool, then send them to ChromaDB in a single query"""
+    loop = asyncio.get_running_loop()
+    embeddings = await loop.run_in_executor(query_executor, run_traced(traced_embed_queries, questions))
+    return await loop.run_in_executor(vector_executor, run_traced(vector_search, index, embeddings, n_results, where))
+
+def keyword_search(index: TenantIndex, question: str, n_results: int,
+                   document_ids: Optional[set] = None) -> List[tuple]:
+    """Best BM25 matches for the question in a tenant's corpus, optionally within a set of documents"""
+    with span("keyword_search", tenant=index.tenant, filtered=document_ids is not None):
+        return index.keyword_index.search(question, n_results, document_ids)
+
+def rerank_candidates(question: str, ranked: List[str], hits: dict) -> List[tuple]:
+    """Score retrieved candidates with the reranker and keep the best RERANK_TOP_K"""
+    with span("rerank", backend=RERANK_BACKEND, candidates=len(ranked)):
+        return rerank(reranker, question, ranked, [hits[chunk_id][0] for chunk_id in ranked], RERANK_TOP_K)
+
+async def rank_hits(index: TenantIndex, question: str, hits: dict, keyword_hits: Optional[List[tuple]],
+                    candidates: int) -> RetrievedContext:
+    """Fuse, rerank and pack the vector (and keyword) hits for one question"""
+    loop = asyncio.get_running_loop()
+    if keyword_hits is None:
+        ranked = list(hits)
+    else:
+        ranked = reciprocal_rank_fusion([list(hits), [chunk_id for chunk_id, _ in keyword_hits]], k=RRF_K)
+        ranked = ranked[:candidates]
+        missing = [chunk_id for chunk_id in ranked if chunk_id not in hits]
+        if missing:
+            extra = await loop.run_in_executor(
+                vector_executor, functools.partial(index.collection.get, ids=missing, include=["documents", "metadatas"])
+            )
+            hits.update({chunk_id: (doc, metadata) for chunk_id, doc, metadata
+                         in zip(extra['ids'], extra['documents'], extra['metadatas'])})
+            ranked = [chunk_id for chunk_id in ranked if chunk_id in hits]
+    
+    scores = None
+    if reranker is not None and ranked:
+        try:
+            reranked = await asyncio.wait_for(
+                loop.run_in_executor(query_executor, run_traced(rerank_candidates, question, ranked, hits)),
+                RERANK_TIMEOUT
+            )
+            ranked, scores = [chunk_id for chunk_id, _ in reranked], [score for _, score in reranked]
+        except asyncio.TimeoutError:
+            logging.warning(f"Reranking {len(ranked)} candidates took over {RERANK_TIMEOUT}s, using retrieval order")
+            metrics.RERANK_TIMEOUTS.inc()
+            ranked = ranked[:RERANK_TOP_K]
+    
+    if not ranked:
+        return RetrievedContext()
+    return pack_context(ranked, [hits[c][0] for c in ranked], [hits[c][1] for c in ranked], scores=scores)
+
+async def retrieve_contexts(tenant: str, questions: List[str],
+                            filters: Optional[RetrievalFilter] = None) -> List[RetrievedContext]:
+    """Search a tenant's corpus for relevant chunks for each question and pack them into the context budget
+    
+    The questions share one batched embedding and ChromaDB query. With
+    HYBRID_SEARCH the keyword searches run alongside it and the rankings are
+    merged with reciprocal rank fusion. With a reranker, RERANK_CANDIDATES are
+    fetched and only the best-scoring ones are packed. Filters are evaluated
+    inside ChromaDB and the keyword index, so only chunks of the selected
+    documents are ever scored.
+    """
+    loop = asyncio.get_running_loop()
+    candidates = RERANK_CANDIDATES if reranker is not None else RETRIEVAL_CANDIDATES
+    where = build_where(filters)
+    if filters is not None and filters.document_ids == []:
+        return [RetrievedContext() for _ in questions]
+    index = await get_tenant_index(tenant)
+    version = index.version
+    keys = [(tenant, normalize_question(question), json.dumps(where, sort_keys=True, default=str), candidates,
+             HYBRID_SEARCH, version) for question in questions]
+    results = [retrieval_cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    try:
+        if missing:
+            searched = [questions[i] for i in missing]
+            if not HYBRID_SEARCH:
+                hits = await search_vectors(index, searched, candidates, where)
+                keyword_hits = [None] * len(searched)
+            else:
+                document_ids = await filtered_document_ids(tenant, filters)
+                if document_ids is not None and not document_ids:
+                    return [RetrievedContext() for _ in questions]
+                hits, *keyword_hits = await asyncio.gather(
+                    search_vectors(index, searched, candidates, where),
+                    *(loop.run_in_executor(
+                        vector_executor, run_traced(keyword_search, index, question, candidates, document_ids)
+                    ) for question in searched)
+                )
+            for i, question_hits, question_keyword_hits in zip(missing, hits, keyword_hits):
+                results[i] = (question_hits, question_keyword_hits)
+                retrieval_cache.put(keys[i], results[i])
+        # rank_hits adds chunks to the hits it is given, so each call gets a copy
+        return list(await asyncio.gather(*(
+            rank_hits(index, question, dict(question_hits), question_keyword_hits, candidates)
+            for question, (question_hits, question_keyword_hits) in zip(questions, results)
+        )))
+    except Exception as e:
+        logging.error(f"Error querying ChromaDB: {e}")
+    
+    return [RetrievedContext() for _ in questions]
+
+async def retrieve_context(tenant: str, question: str, filters: Optional[RetrievalFilter] = None) -> RetrievedContext:
+    """Relevant chunks for a single question, packed into the context budget"""
+    return (await retrieve_contexts(tenant, [question], filters))[0]
+
+def build_prompt(question: str, context: str, history: Optional[ChatHistory] = None) -> list:
+    """Build the LLM messages for a question, its retrieved context and prior turns"""
     user_prompt = f"""Context from knowledge base:
 {context if context else "No relevant documents found in the knowledge base."}
 
-User question: {request.message}
+User question: {question}
 
 Please provide a helpful response based on the context above. If you reference information from the documents, mention which source it came from."""
-   #model="gpt-4.1-mini"
-    try:
-        chat_instance = ChatOpenAI(
-        model="gpt-4.1-mini",   # or gpt-4.1
-        api_key=OPENAI_API_KEY,
-        temperature=0.7
-         )
+    system_prompt = SYSTEM_PROMPT
+    if history and history.summary:
+        system_prompt += f"\n\nSummary of the earlier conversation:\n{history.summary}"
+    messages = [SystemMessage(content=system_prompt)]
+    for msg in history.messages if history else []:
+        messages.append(HumanMessage(content=msg['content']) if msg['role'] == 'user' else AIMessage(content=msg['content']))
+    messages.append(HumanMessage(content=user_prompt))
+    return messages
 
-        messages = [
-        SystemMessage(content=system_prompt),
-        HumanMessage(content=user_prompt)
-         ]
+def count_prompt_tokens(messages: list) -> int:
+    """Approximate prompt size, including a few tokens of framing per message"""
+    return sum(count_tokens(m.content) + 4 for m in messages)
 
-        response = await chat_instance.ainvoke(messages)
-        response_text = response.content
+async def load_history(tenant: str, conversation_id: str) -> ChatHistory:
+    """Load the rolling summary and the unsummarized turns that fit the history budget
+    
+    The newest unsummarized messages that fit the window are sent verbatim.
+    Overflow for the summary is read from the oldest unsummarized message on,
+    at most 2 * HISTORY_MAX_MESSAGES at a time, so `summary_until` never skips
+    past messages that were not summarized; a long backlog is caught up over
+    several turns.
+    """
+    await turn_writer.wait_for(conversation_id)
+    conv = await db.conversations.find_one(
+        {"tenant_id": tenant, "id": conversation_id}, {"_id": 0, "summary": 1, "summary_until": 1, "filters": 1}
+    ) or {}
+    history = ChatHistory(summary=conv.get('summary', ""), summary_until=conv.get('summary_until'),
+                          filters=conv.get('filters'))
+    
+    query = {"tenant_id": tenant, "conversation_id": conversation_id}
+    if history.summary_until:
+        query["created_at"] = {"$gt": history.summary_until}
+    recent = await db.messages.find(
+        query, {"_id": 0, "role": 1, "content": 1, "created_at": 1}
+    ).sort("created_at", -1).limit(2 * HISTORY_MAX_MESSAGES).to_list(None)
+    
+    # Newest first: keep messages while they fit, everything older overflows
+    for i, msg in enumerate(recent):
+        tokens = count_tokens(msg['content']) + 4
+        if i >= HISTORY_MAX_MESSAGES or history.tokens + tokens > HISTORY_TOKEN_BUDGET:
+            break
+        history.messages.insert(0, msg)
+        history.tokens += tokens
+    
+    if len(history.messages) < len(recent):
+        if history.messages:
+            query["created_at"] = {**query.get("created_at", {}), "$lt": history.messages[0]['created_at']}
+        history.overflow = await db.messages.find(
+            query, {"_id": 0, "role": 1, "content": 1, "created_at": 1}
+        ).sort("created_at", 1).limit(2 * HISTORY_MAX_MESSAGES).to_list(None)
+    return history
 
-    except Exception as e:
-        logging.error(f"Error calling LLM: {e}")
-        response_text = (
-        "I apologize, but I encountered an error processing your request. "
-        f"Please try again. Error: {str(e)}"
+async def summarize_history(conversation_id: str, history: ChatHistory):
+    """Fold overflowed turns into the conversation's rolling summary"""
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in history.overflow)
+    prompt = [
+        SystemMessage(content="You maintain a concise running summary of a conversation between a user and a document assistant. Keep facts, names, and open questions; drop pleasantries."),
+        HumanMessage(content=f"Current summary:\n{history.summary or '(none)'}\n\nNew messages:\n{transcript}\n\nWrite the updated summary.")
+    ]
+    try:
+        response = await llm.ainvoke(prompt)
+        # Only apply if no other turn updated the summary in the meantime
+        await db.conversations.update_one(
+            {"id": conversation_id, "summary_until": history.summary_until},
+            {"$set": {"summary": response.content, "summary_until": history.overflow[-1]['created_at']}}
         )
+    except Exception as e:
+        logging.error(f"Error summarizing conversation {conversation_id}: {e}")
+
+def schedule_summary(conversation_id: str, history: ChatHistory):
+    """Update the rolling summary in the background once turns overflow the window"""
+    if history.overflow:
+        task = asyncio.create_task(summarize_history(conversation_id, history))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
+async def prepare_chat_turn(request: ChatRequest, tenant: str):
+    """Retrieve context and build the prompt with history
     
-    # Save assistant message
-    assistant_message = Message(
+    The user message is created here, so it is timestamped before the answer,
+    but only saved together with the answer by `finish_chat_turn`.
+    """
+    with span("history_load"):
+        history = await load_history(tenant, request.conversation_id)
+    user_message = Message(
+        tenant_id=tenant,
         conversation_id=request.conversation_id,
+        role="user",
+        content=request.message
+    )
+    
+    with span("retrieval") as fields:
+        retrieved = await retrieve_context(tenant, request.message, request.filters or history.filters)
+        fields["chunks"] = retrieved.usage.chunks_used
+    with span("prompt_build") as fields:
+        prompt = build_prompt(request.message, retrieved.context, history)
+        retrieved.usage.history_tokens = history.tokens
+        retrieved.usage.prompt_tokens = count_prompt_tokens(prompt)
+        fields.update(retrieved.usage.model_dump())
+    metrics.PROMPT_TOKENS.inc(retrieved.usage.prompt_tokens, part="total")
+    metrics.PROMPT_TOKENS.inc(retrieved.usage.context_tokens, part="context")
+    metrics.PROMPT_TOKENS.inc(retrieved.usage.history_tokens, part="history")
+    return retrieved, prompt, history, user_message
+
+def record_completion_tokens(message):
+    """Count completion tokens when the model reports usage"""
+    usage = getattr(message, "usage_metadata", None)
+    if usage and usage.get("output_tokens"):
+        metrics.COMPLETION_TOKENS.inc(usage["output_tokens"])
+
+def llm_error_text(e: Exception) -> str:
+    """User-facing message for a failed model call; details stay in the logs"""
+    if isinstance(e, openai.RateLimitError):
+        return "The assistant is handling too many requests right now. Please try again in a moment."
+    if isinstance(e, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return "The assistant took too long to respond. Please try again."
+    return "I apologize, but I encountered an error processing your request. Please try again."
+
+async def finish_chat_turn(user_message: Message, history: ChatHistory, response_text: str,
+                           sources: List[dict]) -> Message:
+    """Save the turn's messages and touch the conversation, titling it on the first turn"""
+    assistant_message = Message(
+        tenant_id=user_message.tenant_id,
+        conversation_id=user_message.conversation_id,
         role="assistant",
         content=response_text,
         sources=sources
     )
-    assistant_msg_dict = assistant_message.model_dump()
-    assistant_msg_dict['created_at'] = assistant_msg_dict['created_at'].isoformat()
-    await db.messages.insert_one(assistant_msg_dict)
-    
-    # Update conversation title if first message
-    messages_count = await db.messages.count_documents({"conversation_id": request.conversation_id})
-    if messages_count == 2:  # First user + first assistant message
-        title = request.message[:50] + "..." if len(request.message) > 50 else request.message
-        await db.conversations.update_one(
-            {"id": request.conversation_id},
-            {"$set": {"title": title, "updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
+    title = None
+    if not history.messages and not history.overflow and not history.summary:
+        question = user_message.content
+        title = question[:50] + "..." if len(question) > 50 else question
+    
+    turn = (user_message.conversation_id, [user_message, assistant_message], title)
+    if WRITE_BEHIND:
+        turn_writer.submit(*turn)
     else:
-        await db.conversations.update_one(
-            {"id": request.conversation_id},
-            {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
+        with span("persistence"):
+            await write_turns([turn])
     
-    return ChatResponse(message=assistant_message, sources=sources)
+    return assistant_message
+
+def sse_event(event: str, data) -> str:
+    """Format a Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# Chat endpoint with RAG
+@api_router.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, tenant: str = Depends(get_tenant)):
+    """Send a message and get AI response with RAG"""
+    retrieved, prompt, history, user_message = await prepare_chat_turn(request, tenant)
+    
+    # Generate response with LLM, unless the same question was answered from the same chunks.
+    # Follow-ups depend on earlier turns, so only opening questions use the answer cache.
+    use_cache = not history.messages and not history.summary
+    loop = asyncio.get_running_loop()
+    response_text = None
+    if use_cache:
+        response_text = await loop.run_in_executor(cpu_executor, answer_cache.get, request.message, retrieved.chunk_ids)
+    if response_text is None:
+        try:
+            with span("llm_call"):
+                response = await llm.ainvoke(prompt)
+            response_text = response.content
+            record_completion_tokens(response)
+            if use_cache:
+                await loop.run_in_executor(
+                    cpu_executor, answer_cache.put, request.message, retrieved.chunk_ids, response_text, retrieved.sources
+                )
+        except Exception as e:
+            logging.error(f"Error calling LLM: {e}")
+            response_text = llm_error_text(e)
+    
+    assistant_message = await finish_chat_turn(user_message, history, response_text, retrieved.sources)
+    schedule_summary(request.conversation_id, history)
+    
+    return ChatResponse(message=assistant_message, sources=retrieved.sources, usage=retrieved.usage)
+
+@api_router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, tenant: str = Depends(get_tenant)):
+    """Send a message and stream the AI response as Server-Sent Events
+    
+    Emits a `sources` event first, then a `usage` event with prompt token
+    counts, one `token` event per generated chunk, and finally a `done` event
+    carrying the persisted assistant message.
+    """
+    retrieved, prompt, history, user_message = await prepare_chat_turn(request, tenant)
+    sources, chunk_ids = retrieved.sources, retrieved.chunk_ids
+    use_cache = not history.messages and not history.summary
+    
+    async def event_stream():
+        yield sse_event("sources", sources)
+        yield sse_event("usage", retrieved.usage.model_dump())
+        
+        loop = asyncio.get_running_loop()
+        cached = None
+        if use_cache:
+            cached = await loop.run_in_executor(cpu_executor, answer_cache.get, request.message, chunk_ids)
+        parts = []
+        try:
+            if cached is not None:
+                parts.append(cached)
+                yield sse_event("token", {"content": cached})
+            else:
+                with span("llm_call", streamed=True):
+                    async for chunk in llm.astream(prompt):
+                        record_completion_tokens(chunk)
+                        if chunk.content:
+                            parts.append(chunk.content)
+                            yield sse_event("token", {"content": chunk.content})
+                if use_cache:
+                    await loop.run_in_executor(cpu_executor, answer_cache.put, request.message, chunk_ids, "".join(parts), sources)
+        except Exception as e:
+            logging.error(f"Error calling LLM: {e}")
+            parts = [llm_error_text(e)]
+            yield sse_event("error", {"detail": parts[0]})
+        
+        assistant_message = await finish_chat_turn(user_message, history, "".join(parts), sources)
+        schedule_summary(request.conversation_id, history)
+        yield sse_event("done", assistant_message.model_dump(mode="json"))
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Batch question answering
+def parse_batch_line(index: int, line: str):
+    """A BatchQuestion for a JSONL line, or an error result for the line"""
+    try:
+        return BatchQuestion.model_validate_json(line)
+    except ValueError as e:
+        return {"index": index, "error": f"Invalid question: {e}"}
+
+async def answer_batch_item(index: int, item: BatchQuestion, retrieved: RetrievedContext,
+                            semaphore: asyncio.Semaphore, started: float, retrieval_seconds: float) -> dict:
+    """Answer one retrieved batch question and time it"""
+    result = {
+        "index": index,
+        "id": item.id,
+        "question": item.question,
+        "answer": None,
+        "sources": retrieved.sources,
+        "usage": retrieved.usage.model_dump(),
+        "completion_tokens": None,
+        "retrieval_ms": round(retrieval_seconds * 1000, 2),
+    }
+    prompt = build_prompt(item.question, retrieved.context)
+    result["usage"]["prompt_tokens"] = count_prompt_tokens(prompt)
+    async with semaphore:
+        llm_started = time.perf_counter()
+        try:
+            response = await llm.ainvoke(prompt)
+            result["answer"] = response.content
+            record_completion_tokens(response)
+            usage = getattr(response, "usage_metadata", None)
+            result["completion_tokens"] = usage.get("output_tokens") if usage else None
+        except Exception as e:
+            logging.error(f"Error calling LLM for batch question {index}: {e}")
+            result["error"] = llm_error_text(e)
+        result["llm_ms"] = round((time.perf_counter() - llm_started) * 1000, 2)
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
+def batch_turn(tenant: str, conversation_id: str, result: dict) -> tuple:
+    """A batch question and its answer as a turn of the batch's conversation"""
+    user_message = Message(tenant_id=tenant, conversation_id=conversation_id, role="user", content=result["question"])
+    assistant_message = Message(tenant_id=tenant, conversation_id=conversation_id, role="assistant",
+                                content=result["answer"] or result.get("error", ""), sources=result["sources"])
+    return conversation_id, [user_message, assistant_message], None
+
+async def answer_batch(tenant: str, lines: List[str], concurrency: int = BATCH_CONCURRENCY, persist: bool = False):
+    """Answer JSONL questions from a tenant's corpus, yielding one result dict per line as each finishes
+    
+    Questions are independent: no conversation history is used and the answer
+    cache is bypassed. Each slice of BATCH_CHUNK_SIZE questions is retrieved
+    together, one batched ChromaDB query per distinct filter, while model calls
+    for the previous slice are still running. Nothing is written to MongoDB
+    unless `persist` is set, in which case the batch is saved as a single
+    conversation.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    conversation_id = None
+    if persist:
+        conversation = Conversation(tenant_id=tenant, title=f"Batch of {len(lines)} questions")
+        await db.conversations.insert_one(conversation.model_dump())
+        conversation_id = conversation.id
+    
+    pending = set()
+    
+    async def finished(wait_for_all: bool):
+        while pending and (wait_for_all or len(pending) >= BATCH_CHUNK_SIZE):
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            results = [task.result() for task in done]
+            if persist:
+                await write_turns([batch_turn(tenant, conversation_id, result) for result in results])
+            for result in results:
+                yield result
+    
+    for start in range(0, len(lines), BATCH_CHUNK_SIZE):
+        started = time.perf_counter()
+        items = {}
+        for index, line in enumerate(lines[start:start + BATCH_CHUNK_SIZE], start):
+            if not line.strip():
+                continue
+            item = parse_batch_line(index, line)
+            if isinstance(item, dict):
+                yield item
+            else:
+                items[index] = item
+        
+        # One retrieval per distinct filter; usually the whole slice shares one
+        groups: Dict[str, List[int]] = {}
+        for index, item in items.items():
+            key = item.filters.model_dump_json() if item.filters else ""
+            groups.setdefault(key, []).append(index)
+        with span("batch_retrieval", questions=len(items), groups=len(groups)):
+            retrieved = {}
+            for indexes in groups.values():
+                contexts = await retrieve_contexts(tenant, [items[i].question for i in indexes], items[indexes[0]].filters)
+                retrieved.update(zip(indexes, contexts))
+        retrieval_seconds = time.perf_counter() - started
+        
+        for index, item in items.items():
+            pending.add(asyncio.create_task(
+                answer_batch_item(index, item, retrieved[index], semaphore, started, retrieval_seconds)
+            ))
+        async for result in finished(wait_for_all=False):
+            yield result
+    
+    async for result in finished(wait_for_all=True):
+        yield result
+
+@api_router.post("/chat/batch")
+async def chat_batch(file: UploadFile = File(...), persist: bool = False,
+                     concurrency: int = Query(BATCH_CONCURRENCY, ge=1, le=LLM_MAX_CONCURRENCY),
+                     tenant: str = Depends(get_tenant)):
+    """Answer a JSONL file of questions and stream the results back as JSONL
+    
+    Each input line is {"question": ..., "id": optional, "filters": optional}.
+    Each output line carries the question's `index` and `id`, the answer and
+    sources, prompt and completion token usage, and retrieval, model and
+    total latency in milliseconds. Results are written as they finish, so
+    their order may differ from the input.
+    """
+    lines = (await file.read()).decode('utf-8').splitlines()
+    
+    async def results():
+        async for result in answer_batch(tenant, lines, concurrency, persist):
+            yield json.dumps(result, default=str) + "\n"
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson")
 
 # Status endpoint
 @api_router.get("/")
 async def root():
     return {"message": "Knowledge Assistant API", "status": "running"}
 
+@api_router.get("/cache/stats")
+async def get_cache_stats(tenant: str = Depends(get_tenant)):
+    """Get answer cache hit/miss counters, with those of the query embedding and retrieval caches"""
+    index = tenant_indexes.get(tenant)
+    return {
+        **answer_cache.stats(),
+        "query_embedding": query_embedding_cache.stats(),
+        "retrieval": {**retrieval_cache.stats(), "corpus_version": index.version if index else None}
+    }
+
 # Include the router
 app.include_router(api_router)
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus metrics"""
+    stats = answer_cache.stats()
+    for result in ("hits", "similar_hits", "misses"):
+        metrics.CACHE_REQUESTS.set(stats[result], cache="answer", result=result)
+    metrics.CACHE_ENTRIES.set(stats["entries"], cache="answer")
+    for name, cache in (("query_embedding", query_embedding_cache), ("retrieval", retrieval_cache)):
+        stats = cache.stats()
+        for result in ("hits", "misses"):
+            metrics.CACHE_REQUESTS.set(stats[result], cache=name, result=result)
+        metrics.CACHE_ENTRIES.set(stats["entries"], cache=name)
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Tag each request with an ID for log spans and record its latency"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    metrics.request_id_var.set(request_id)
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=route.path if route else "unmatched",
+        status=response.status_code
+    )
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Request-ID"],
 )
 
 # Configure logging
@@ -386,6 +2367,76 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def ensure_indexes():
+    """Create the MongoDB indexes behind lookups and pagination, all scoped by tenant"""
+    await db.documents.create_index("id", unique=True)
+    await db.documents.create_index([("tenant_id", 1), ("created_at", -1), ("id", -1)])
+    await db.documents.create_index([("tenant_id", 1), ("content_hash", 1)])
+    await db.documents.create_index([("tenant_id", 1), ("filename", 1)])
+    await db.conversations.create_index("id", unique=True)
+    await db.conversations.create_index([("tenant_id", 1), ("updated_at", -1), ("id", -1)])
+    await db.messages.create_index("id", unique=True)
+    await db.messages.create_index([("tenant_id", 1), ("conversation_id", 1), ("created_at", 1), ("id", 1)])
+
+async def migrate_timestamps():
+    """Convert ISO-string timestamps written by earlier versions to BSON dates"""
+    for mongo_collection, fields in (
+        (db.documents, ["created_at"]),
+        (db.conversations, ["created_at", "updated_at", "summary_until"]),
+        (db.messages, ["created_at"])
+    ):
+        for field in fields:
+            legacy = await mongo_collection.find(
+                {field: {"$type": "string"}}, {"_id": 1, field: 1}
+            ).to_list(None)
+            if legacy:
+                await mongo_collection.bulk_write([
+                    UpdateOne({"_id": doc['_id']}, {"$set": {field: datetime.fromisoformat(doc[field])}})
+                    for doc in legacy
+                ])
+                logging.info(f"Converted {len(legacy)} {mongo_collection.name}.{field} values to dates")
+
+async def migrate_tenants():
+    """Assign records written before tenants existed to DEFAULT_TENANT"""
+    for mongo_collection in (db.documents, db.conversations, db.messages):
+        result = await mongo_collection.update_many(
+            {"tenant_id": {"$exists": False}}, {"$set": {"tenant_id": DEFAULT_TENANT}}
+        )
+        if result.modified_count:
+            logging.info(f"Assigned {result.modified_count} {mongo_collection.name} to tenant {DEFAULT_TENANT}")
+
+@app.on_event("startup")
+async def prepare_database():
+    await migrate_timestamps()
+    await migrate_tenants()
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def check_vector_store():
+    await reconcile_vector_store()
+    if HYBRID_SEARCH:
+        for tenant in await all_tenants():
+            index = await get_tenant_index(tenant)
+            await asyncio.get_running_loop().run_in_executor(vector_executor, rebuild_keyword_index, index)
+
+@app.on_event("startup")
+async def start_garbage_collector():
+    if GC_INTERVAL > 0:
+        task = asyncio.create_task(run_garbage_collector())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for job in list(ingest_jobs.values()):
+        job.cancel()
+    for task in list(background_tasks):
+        task.cancel()
+    cpu_executor.shutdown(wait=False, cancel_futures=True)
+    vector_executor.shutdown(wait=False, cancel_futures=True)
+    query_executor.shutdown(wait=False, cancel_futures=True)
+    extract_pool.shutdown(wait=False, cancel_futures=True)
+    await turn_writer.close()
     client.close()
+    await llm.aclose()
+    embedder.close()
@@ -0,0 +1,156 @@
+"""Knowledge base snapshots: document records, chunk text, metadata and vectors in one file.
+
+A snapshot is an uncompressed tar archive holding:
+
+- manifest.json: format version, embedding model, vector dimension and counts
+- documents.jsonl: one document record per line
+- chunks.jsonl: one {"id", "text", "metadata"} object per line
+- embeddings.npy: a float32 matrix whose row i is the vector of line i of chunks.jsonl
+
+Both sides go through temporary files one page of chunks at a time, so neither
+holds the corpus in memory. Vectors are stored as computed, so loading a
+snapshot needs no extraction or embedding, only the same embedding model.
+"""
+import json
+import shutil
+import tarfile
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MEMBERS = ("manifest.json", "documents.jsonl", "chunks.jsonl", "embeddings.npy")
+
+class SnapshotWriter:
+    """Collects documents and chunks in a scratch directory, then writes the archive"""
+
+    def __init__(self, model: str, work_dir: Optional[str] = None):
+        self.model = model
+        self.dimension: Optional[int] = None
+        self.documents = 0
+        self.chunks = 0
+        self._dir = tempfile.TemporaryDirectory(dir=work_dir)
+        self.root = Path(self._dir.name)
+        self._documents = open(self.root / "documents.jsonl", "w", encoding="utf-8")
+        self._chunks = open(self.root / "chunks.jsonl", "w", encoding="utf-8")
+        self._vectors = open(self.root / "embeddings.f32", "wb")
+
+    def add_document(self, record: dict):
+        self._documents.write(json.dumps(record, default=str) + "\n")
+        self.documents += 1
+
+    def add_chunks(self, ids: Sequence[str], texts: Sequence[str], metadatas: Sequence[dict], embeddings):
+        if not ids:
+            return
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if self.dimension is None:
+            self.dimension = matrix.shape[1]
+        elif matrix.shape[1] != self.dimension:
+            raise ValueError(f"Vectors of dimension {matrix.shape[1]} and {self.dimension} in one snapshot")
+        for chunk_id, text, metadata in zip(ids, texts, metadatas):
+            self._chunks.write(json.dumps({"id": chunk_id, "text": text, "metadata": metadata}) + "\n")
+        self._vectors.write(np.ascontiguousarray(matrix).tobytes())
+        self.chunks += len(ids)
+
+    def write(self, path) -> dict:
+        """Write the archive to `path` and return its manifest"""
+        for f in (self._documents, self._chunks, self._vectors):
+            f.close()
+        # The .npy header needs the final shape, so the raw rows are copied in behind it
+        header = {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)), "fortran_order": False,
+                  "shape": (self.chunks, self.dimension or 0)}
+        with open(self.root / "embeddings.npy", "wb") as out, open(self.root / "embeddings.f32", "rb") as raw:
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(raw, out)
+        (self.root / "embeddings.f32").unlink()
+
+        manifest = {
+            "format": FORMAT_VERSION,
+            "model": self.model,
+            "dimension": self.dimension,
+            "documents": self.documents,
+            "chunks": self.chunks,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        (self.root / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+        with tarfile.open(path, "w") as tar:
+            for name in MEMBERS:
+                tar.add(self.root / name, arcname=name)
+        return manifest
+
+    def close(self):
+        for f in (self._documents, self._chunks, self._vectors):
+            f.close()
+        self._dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SnapshotReader:
+    """Unpacks an archive into a scratch directory and reads it back in batches
+
+    Only the expected members are extracted. Vectors are memory-mapped.
+    """
+
+    def __init__(self, path, work_dir: Optional[str] = None):
+        self._dir = tempfile.TemporaryDirectory(dir=work_dir)
+        self.root = Path(self._dir.name)
+        try:
+            with tarfile.open(path, "r:*") as tar:
+                for name in MEMBERS:
+                    try:
+                        member = tar.getmember(name)
+                    except KeyError:
+                        raise ValueError(f"Not a knowledge base snapshot: {name} is missing")
+                    source = tar.extractfile(member)
+                    if source is None:
+                        raise ValueError(f"Not a knowledge base snapshot: {name} is not a file")
+                    with source, open(self.root / name, "wb") as target:
+                        shutil.copyfileobj(source, target)
+            self.manifest = json.loads((self.root / "manifest.json").read_text(encoding="utf-8"))
+        except (tarfile.TarError, json.JSONDecodeError) as e:
+            self.close()
+            raise ValueError(f"Not a knowledge base snapshot: {e}")
+        except BaseException:
+            self.close()
+            raise
+        if self.manifest.get("format") != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported snapshot format {self.manifest.get('format')}")
+
+    def documents(self) -> Iterator[dict]:
+        with open(self.root / "documents.jsonl", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def chunks(self, batch_size: int) -> Iterator[tuple]:
+        """Batches of (ids, texts, metadatas, vectors), in file order"""
+        if not self.manifest.get("chunks"):
+            return
+        vectors = np.load(self.root / "embeddings.npy", mmap_mode="r")
+        if vectors.shape[0] != self.manifest["chunks"]:
+            raise ValueError(f"Snapshot has {vectors.shape[0]} vectors for {self.manifest['chunks']} chunks")
+        start = 0
+        with open(self.root / "chunks.jsonl", encoding="utf-8") as f:
+            while True:
+                rows: List[dict] = [json.loads(line) for _, line in zip(range(batch_size), f)]
+                if not rows:
+                    return
+                yield ([row["id"] for row in rows], [row["text"] for row in rows],
+                       [row["metadata"] for row in rows], np.array(vectors[start:start + len(rows)]))
+                start += len(rows)
+
+    def close(self):
+        self._dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
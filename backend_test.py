@@ -91,6 +91,14 @@ class KnowledgeAssistantTester:
             os.unlink(tmp.name)
             return success
 
+    def test_document_upload_batch(self):
+        """Test uploading several documents at once"""
+        files = [
+            ('files', ('batch_one.txt', b'First batch document about retrieval augmented generation.', 'text/plain')),
+            ('files', ('batch_two.md', b'# Second\n\nSecond batch document with an error code ERR-4021.', 'text/markdown')),
+        ]
+        return self.run_test("Document Upload - Batch", "POST", "documents/upload/batch", 200, files=files)
+
     def test_get_documents(self):
         """Test getting all documents"""
         return self.run_test("Get Documents", "GET", "documents", 200)
@@ -140,6 +148,31 @@ class KnowledgeAssistantTester:
         except Exception as e:
             return self.log_test("Chat Flow - Complete", False, None, str(e))
 
+    def test_chat_stream(self):
+        """Test streaming chat over Server-Sent Events"""
+        try:
+            response = requests.post(f"{self.api_url}/conversations", timeout=30)
+            conv_id = response.json()['id']
+            
+            chat_data = {
+                "conversation_id": conv_id,
+                "message": "Summarize the uploaded documents."
+            }
+            events = []
+            with requests.post(f"{self.api_url}/chat/stream", json=chat_data, stream=True, timeout=60) as response:
+                if response.status_code != 200:
+                    return self.log_test("Chat Stream", False, None, f"Expected 200, got {response.status_code}")
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith("event: "):
+                        events.append(line[len("event: "):])
+            
+            success = bool(events) and events[0] == "sources" and events[-1] == "done"
+            print(f"   Events received: {len(events)}")
+            return self.log_test("Chat Stream", success, {"events": events[:3] + events[-1:]},
+                               None if success else "Expected sources first and done last")
+        except Exception as e:
+            return self.log_test("Chat Stream", False, None, str(e))
+
     def test_get_messages(self, conv_id=None):
         """Test getting messages for a conversation"""
         if not conv_id:
@@ -159,6 +192,184 @@ class KnowledgeAssistantTester:
         
         return self.run_test("Get Messages", "GET", f"conversations/{conv_id}/messages", 200)
 
+    def upload_and_wait(self, filename, content, headers=None, timeout=60):
+        """Upload a text document and poll its status until it is ready; returns its ID or None"""
+        files = {'file': (filename, content, 'text/plain')}
+        response = requests.post(f"{self.api_url}/documents/upload", files=files, headers=headers, timeout=30)
+        if response.status_code != 200:
+            return None
+        doc_id = response.json()['id']
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = requests.get(f"{self.api_url}/documents/{doc_id}/status", headers=headers, timeout=30).json()
+            if status.get('status') == 'ready':
+                return doc_id
+            if status.get('status') == 'failed':
+                return None
+            time.sleep(1)
+        return None
+
+    def test_document_status(self):
+        """Test polling a document's processing status"""
+        try:
+            content = f"Status polling test document written at {datetime.now().isoformat()}.".encode()
+            doc_id = self.upload_and_wait("status_test.txt", content)
+            if not doc_id:
+                return self.log_test("Document Status", False, None, "Document did not become ready")
+            response = requests.get(f"{self.api_url}/documents/{doc_id}/status", timeout=30)
+            data = response.json()
+            success = data.get('status') == 'ready' and data.get('progress') == 1.0 and data.get('chunk_count', 0) > 0
+            self.log_test("Document Status", success, data, None if success else "Expected a ready document with chunks")
+            return self.run_test("Document Status - Unknown ID", "GET", "documents/does-not-exist/status", 404) and success
+        except Exception as e:
+            return self.log_test("Document Status", False, None, str(e))
+
+    def test_bulk_delete(self):
+        """Test deleting several documents in one request"""
+        try:
+            doc_ids = [
+                self.upload_and_wait(f"bulk_delete_{i}.txt", f"Bulk delete test {i} at {datetime.now().isoformat()}.".encode())
+                for i in range(2)
+            ]
+            if not all(doc_ids):
+                return self.log_test("Bulk Delete", False, None, "Documents did not become ready")
+            response = requests.post(f"{self.api_url}/documents/delete",
+                                     json={"ids": doc_ids + ["does-not-exist"]}, timeout=30)
+            data = response.json()
+            success = (response.status_code == 200 and sorted(data['deleted']) == sorted(doc_ids)
+                       and data['not_found'] == ["does-not-exist"] and data['pending'] == [])
+            listed = {doc['id'] for doc in requests.get(f"{self.api_url}/documents?limit=100", timeout=30).json()}
+            success = success and not listed & set(doc_ids)
+            return self.log_test("Bulk Delete", success, data,
+                               None if success else "Expected both documents deleted and the unknown ID not found")
+        except Exception as e:
+            return self.log_test("Bulk Delete", False, None, str(e))
+
+    def test_garbage_collect(self):
+        """Test the garbage collection endpoint"""
+        try:
+            response = requests.post(f"{self.api_url}/documents/gc", timeout=60)
+            data = response.json()
+            success = response.status_code == 200 and {"purged", "still_deleting", "orphans_removed"} <= data.keys()
+            return self.log_test("Garbage Collection", success, data, None if success else "Unexpected response")
+        except Exception as e:
+            return self.log_test("Garbage Collection", False, None, str(e))
+
+    def test_documents_pagination(self):
+        """Test walking the document list one item at a time with X-Next-Cursor"""
+        try:
+            seen = []
+            url = f"{self.api_url}/documents?limit=1"
+            while url and len(seen) < 50:
+                response = requests.get(url, timeout=30)
+                if response.status_code != 200:
+                    return self.log_test("Documents Pagination", False, None, f"Expected 200, got {response.status_code}")
+                page = response.json()
+                seen.extend(doc['id'] for doc in page)
+                cursor = response.headers.get('X-Next-Cursor')
+                url = f"{self.api_url}/documents?limit=1&cursor={cursor}" if cursor else None
+            
+            success = len(seen) > 1 and len(seen) == len(set(seen))
+            print(f"   Pages walked: {len(seen)}")
+            return self.log_test("Documents Pagination", success, {"documents": len(seen)},
+                               None if success else "Expected several pages without repeated documents")
+        except Exception as e:
+            return self.log_test("Documents Pagination", False, None, str(e))
+
+    def test_chat_batch(self):
+        """Test answering a JSONL file of questions"""
+        try:
+            questions = "\n".join(json.dumps(q) for q in [
+                {"id": "q1", "question": "What is in the uploaded documents?"},
+                {"id": "q2", "question": "Which error code is mentioned?"},
+            ])
+            files = {'file': ('questions.jsonl', questions.encode(), 'application/x-ndjson')}
+            response = requests.post(f"{self.api_url}/chat/batch", files=files, timeout=120)
+            results = [json.loads(line) for line in response.text.splitlines() if line]
+            success = (response.status_code == 200 and sorted(r.get('id') for r in results) == ["q1", "q2"]
+                       and all('answer' in r for r in results))
+            return self.log_test("Chat Batch", success, {"results": len(results)},
+                               None if success else "Expected one answer per question")
+        except Exception as e:
+            return self.log_test("Chat Batch", False, None, str(e))
+
+    def test_cache_stats(self):
+        """Test the cache statistics endpoint"""
+        try:
+            response = requests.get(f"{self.api_url}/cache/stats", timeout=30)
+            data = response.json()
+            success = (response.status_code == 200 and {"hits", "misses", "hit_rate"} <= data.keys()
+                       and "query_embedding" in data and "retrieval" in data)
+            return self.log_test("Cache Stats", success, data, None if success else "Unexpected response")
+        except Exception as e:
+            return self.log_test("Cache Stats", False, None, str(e))
+
+    def test_metrics(self):
+        """Test the Prometheus metrics endpoint"""
+        try:
+            response = requests.get(f"{self.base_url}/metrics", timeout=30)
+            success = response.status_code == 200 and "# TYPE" in response.text
+            return self.log_test("Metrics", success, None,
+                               None if success else f"Expected Prometheus text, got {response.status_code}")
+        except Exception as e:
+            return self.log_test("Metrics", False, None, str(e))
+
+    def test_snapshot_round_trip(self):
+        """Test exporting the knowledge base and importing it into another tenant"""
+        print("\n📦 Testing snapshot export and import...")
+        tenant = {'X-Tenant-ID': f"backend-test-{int(time.time())}"}
+        try:
+            content = f"Snapshot test document about the ERR-7001 recovery procedure, {datetime.now().isoformat()}.".encode()
+            if not self.upload_and_wait("snapshot_test.txt", content):
+                return self.log_test("Snapshot Round Trip", False, None, "Document did not become ready")
+            
+            response = requests.get(f"{self.api_url}/documents/export", timeout=120)
+            if response.status_code != 200:
+                return self.log_test("Snapshot Export", False, None, f"Expected 200, got {response.status_code}")
+            self.log_test("Snapshot Export", True, {"bytes": len(response.content)})
+            
+            files = {'file': ('knowledge-base.tar', response.content, 'application/x-tar')}
+            response = requests.post(f"{self.api_url}/documents/import", files=files, headers=tenant, timeout=120)
+            report = response.json()
+            if response.status_code != 200 or not report.get('documents'):
+                return self.log_test("Snapshot Import", False, report, f"Expected imported documents, got {response.status_code}")
+            print(f"   Imported {report['documents']} documents, {report['chunks']} chunks")
+            
+            documents = requests.get(f"{self.api_url}/documents?limit=100", headers=tenant, timeout=30).json()
+            imported = {doc['filename']: doc for doc in documents}
+            conv_id = requests.post(f"{self.api_url}/conversations", headers=tenant, timeout=30).json()['id']
+            chat = requests.post(f"{self.api_url}/chat", headers=tenant, timeout=60,
+                                 json={"conversation_id": conv_id, "message": "What is the ERR-7001 recovery procedure?"}).json()
+            success = (imported.get('snapshot_test.txt', {}).get('status') == 'ready'
+                       and any(s.get('filename') == 'snapshot_test.txt' for s in chat.get('sources', [])))
+            self.log_test("Snapshot Import", success, report,
+                          None if success else "Imported document is not ready or not retrieved in the new tenant")
+            
+            requests.post(f"{self.api_url}/documents/delete", json={"ids": [doc['id'] for doc in documents]},
+                          headers=tenant, timeout=60)
+            
+            files = {'file': ('not-a-snapshot.tar', b'not a tar archive', 'application/x-tar')}
+            response = requests.post(f"{self.api_url}/documents/import", files=files, headers=tenant, timeout=30)
+            return self.log_test("Snapshot Import - Invalid File", response.status_code == 400, response.json(),
+                                 None if response.status_code == 400 else f"Expected 400, got {response.status_code}") and success
+        except Exception as e:
+            return self.log_test("Snapshot Round Trip", False, None, str(e))
+
+    def test_conversation_export(self):
+        """Test downloading a conversation as Markdown"""
+        try:
+            conv_id = requests.post(f"{self.api_url}/conversations", timeout=30).json()['id']
+            requests.post(f"{self.api_url}/chat", timeout=60,
+                          json={"conversation_id": conv_id, "message": "What is in the uploaded documents?"})
+            response = requests.get(f"{self.api_url}/conversations/{conv_id}/export?format=markdown", timeout=30)
+            text = response.text
+            success = (response.status_code == 200 and text.startswith("# ")
+                       and "**You**" in text and "**Assistant**" in text)
+            return self.log_test("Conversation Export - Markdown", success, {"length": len(text)},
+                               None if success else "Expected a Markdown transcript with both speakers")
+        except Exception as e:
+            return self.log_test("Conversation Export - Markdown", False, None, str(e))
+
     def test_delete_operations(self):
         """Test delete operations for conversations and documents"""
         print("\n🗑️  Testing delete operations...")
@@ -210,7 +421,10 @@ class KnowledgeAssistantTester:
         time.sleep(2)  # Wait for processing
         self.test_document_upload_pdf()
         time.sleep(2)  # Wait for processing
+        self.test_document_upload_batch()
         self.test_get_documents()
+        self.test_document_status()
+        self.test_documents_pagination()
         
         # Conversation management tests
         self.test_create_conversation()
@@ -218,10 +432,18 @@ class KnowledgeAssistantTester:
         
         # Chat and RAG functionality
         self.test_chat_flow()
+        self.test_chat_stream()
+        self.test_chat_batch()
         time.sleep(3)  # Wait for chat completion
         self.test_get_messages()
+        self.test_cache_stats()
+        self.test_metrics()
+        self.test_conversation_export()
+        self.test_snapshot_round_trip()
         
         # Cleanup tests
+        self.test_bulk_delete()
+        self.test_garbage_collect()
         self.test_delete_operations()
         
         # Print summary
@@ -26,6 +26,8 @@ import { Progress } from "./components/ui/progress";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+// Give up polling a document's status after this many one-second attempts
+const MAX_STATUS_POLLS = 600;
 
 // Sidebar Component
 const Sidebar = ({ 
@@ -132,7 +134,13 @@ const Sidebar = ({
                   <FileText className="w-4 h-4 text-orange-500 flex-shrink-0" strokeWidth={1.5} />
                   <div className="min-w-0">
                     <span className="text-sm text-stone-200 truncate block">{doc.filename}</span>
-                    <span className="text-xs text-stone-500">{doc.chunk_count} chunks</span>
+                    <span className="text-xs text-stone-500">
+                      {doc.status === "processing"
+                        ? `Processing ${Math.round((doc.progress || 0) * 100)}%`
+                        : doc.status === "failed"
+                          ? "Processing failed"
+                          : `${doc.chunk_count} chunks`}
+                    </span>
                   </div>
                 </div>
                 <button
@@ -466,6 +474,18 @@ const Home = () => {
     fetchDocuments();
   }, []);
 
+  // List endpoints are paginated; follow X-Next-Cursor until the last page
+  const fetchAllPages = async (url) => {
+    let items = [];
+    let cursor = null;
+    do {
+      const response = await axios.get(url, { params: { limit: 1000, ...(cursor && { cursor }) } });
+      items = items.concat(response.data);
+      cursor = response.headers['x-next-cursor'];
+    } while (cursor);
+    return items;
+  };
+
   const fetchConversations = async () => {
     try {
       const response = await axios.get(`${API}/conversations`);
@@ -478,8 +498,7 @@ const Home = () => {
 
   const fetchDocuments = async () => {
     try {
-      const response = await axios.get(`${API}/documents`);
-      setDocuments(response.data);
+      setDocuments(await fetchAllPages(`${API}/documents`));
     } catch (e) {
       console.error("Error fetching documents:", e);
       toast.error("Failed to load documents");
@@ -488,8 +507,7 @@ const Home = () => {
 
   const fetchMessages = async (conversationId) => {
     try {
-      const response = await axios.get(`${API}/conversations/${conversationId}/messages`);
-      setMessages(response.data);
+      setMessages(await fetchAllPages(`${API}/conversations/${conversationId}/messages`));
     } catch (e) {
       console.error("Error fetching messages:", e);
       toast.error("Failed to load messages");
@@ -533,6 +551,34 @@ const Home = () => {
     }
   };
 
+  const pollDocumentStatus = (docId, filename) => {
+    let attempts = 0;
+    const poll = setInterval(async () => {
+      attempts += 1;
+      try {
+        const response = await axios.get(`${API}/documents/${docId}/status`);
+        const status = response.data;
+        setDocuments(prev => prev.map(d => d.id === docId ? { ...d, ...status } : d));
+        if (status.status === "ready") {
+          clearInterval(poll);
+          toast.success(`${filename} is ready`);
+        } else if (status.status === "failed") {
+          clearInterval(poll);
+          toast.error(`Failed to process ${filename}`);
+        } else if (status.status === "stale") {
+          clearInterval(poll);
+          toast.error(`Processing of ${filename} was interrupted; reindex it to retry`);
+        } else if (status.status !== "processing" || attempts >= MAX_STATUS_POLLS) {
+          // Unknown status, or still processing after the cap
+          clearInterval(poll);
+        }
+      } catch (e) {
+        // Document was deleted or the server is unreachable
+        clearInterval(poll);
+      }
+    }, 1000);
+  };
+
   const handleUpload = async (file) => {
     setIsUploading(true);
     setUploadProgress(0);
@@ -553,8 +599,13 @@ const Home = () => {
       clearInterval(progressInterval);
       setUploadProgress(100);
       
-      setDocuments([response.data, ...documents]);
-      toast.success(`${file.name} uploaded successfully`);
+      setDocuments(prev => [response.data, ...prev.filter(d => d.id !== response.data.id)]);
+      if (response.data.status === 'ready') {
+        toast.success(`${file.name} is already in the knowledge base`);
+      } else {
+        toast.success(`${file.name} uploaded, processing...`);
+        pollDocumentStatus(response.data.id, file.name);
+      }
       
       setTimeout(() => {
         setShowUploadModal(false);
@@ -0,0 +1,58 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from extraction import PARAGRAPH, Block, extract_blocks_from_txt, iter_chunks  # noqa: E402
+
+
+def test_paragraphs_split_when_lines_end_in_whitespace():
+    text = "".join(f"word{i} alpha beta{' ' if i % 2 else chr(9)}\n\n" for i in range(5000))
+    paragraphs = PARAGRAPH.findall(text)
+    assert len(paragraphs) == 5000
+    assert paragraphs[0] == "word0 alpha beta"
+
+
+def test_paragraphs_split_on_crlf_blank_lines():
+    assert PARAGRAPH.findall("first line\r\nsame paragraph \r\n\r\nsecond\r\n") == [
+        "first line\r\nsame paragraph", "second"
+    ]
+
+
+def test_chunks_keep_paragraphs_whole_despite_trailing_spaces():
+    text = "".join(f"word{i} " + "alpha beta gamma " * 10 + " \n\n" for i in range(200))
+    chunks = list(iter_chunks([Block(text)], chunk_tokens=128, overlap_tokens=16))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        for paragraph in chunk.text.split("\n\n"):
+            assert paragraph.startswith("word") and paragraph.endswith("gamma")
+
+
+def test_page_text_splits_into_paragraphs():
+    page = "".join(f"Line {i} of the page.   \n\n" for i in range(100))
+    chunks = list(iter_chunks([Block(page, page=3)], chunk_tokens=64, overlap_tokens=8))
+    assert len(chunks) > 1
+    assert all(chunk.text.startswith("Line") for chunk in chunks)
+
+
+def test_hash_lines_in_code_fences_are_not_headings():
+    markdown = (
+        "# Setup\n\nInstall the tools.\n\n"
+        "```bash\n# not a heading\npip install -r requirements.txt\n```\n\n"
+        "~~~\n## also code\n~~~\n\n"
+        "## Usage\n\nRun it.\n"
+    )
+    blocks = list(extract_blocks_from_txt(markdown.encode()))
+    assert [block.heading for block in blocks if "not a heading" in block.text] == ["Setup"]
+    assert [block.heading for block in blocks if "also code" in block.text] == ["Setup"]
+    assert blocks[-1].heading == "Usage"
+
+    chunks = list(iter_chunks(blocks))
+    assert [chunk.heading for chunk in chunks] == ["Setup", "Usage"]
+    assert "```bash\n# not a heading\npip install -r requirements.txt\n```" in chunks[0].text
+
+
+def test_chunk_spanning_pages_records_last_page():
+    blocks = [Block("first page text", page=1), Block("second page text", page=2)]
+    chunks = list(iter_chunks(blocks, chunk_tokens=64, overlap_tokens=8))
+    assert [(chunk.page, chunk.page_end) for chunk in chunks] == [(1, 2)]